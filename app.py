@@ -1,6 +1,8 @@
 import sys, os
+from startup import profile
 from looper import *
 from device_manager import MIDIDeviceMonitor
+from transport import Transport
 from gui import MainWindow
 from PyQt6.QtWidgets import QApplication
 from PyQt6.QtCore import Qt, QThread, pyqtSlot, pyqtSignal, QObject, QTimer
@@ -17,10 +19,19 @@ class MIDIDeviceMonitorWorker(QObject):
 
 if __name__ == "__main__":
 
+    profile.mark("imports")
     looper = Looper(bpm=120, beats=16, track_count=8)
     qtapp = QApplication(sys.argv)
     win = MainWindow(looper)
+    profile.mark("window built")
 
+    # playback runs on the transport thread, scheduling 50ms ahead
+    transport = Transport(looper, lookahead=0.05)
+    transport.start()
+    qtapp.aboutToQuit.connect(transport.stop)
+    qtapp.aboutToQuit.connect(looper.metronome.close)
+
+    # the GUI timer only draws the playhead
     timer = QTimer()
     timer.timeout.connect(looper.update)  # looper.update should be non-blocking
     timer.start(16)  # ~60Hz
@@ -36,6 +47,12 @@ if __name__ == "__main__":
     win.connectDeviceMonitor(monitor)    
     
     win.show()
+    profile.mark("window shown")
+    QTimer.singleShot(0, lambda: profile.mark("event loop running"))
+    
+    # soundfonts and audio devices load behind the window
+    looper.initialiseAudio()
+    
     sys.exit(qtapp.exec())
     
     looper_thread.join()
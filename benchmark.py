@@ -0,0 +1,437 @@
+import io
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+import mido
+import numpy as np
+
+from midi import Track, BEATS_PER_BAR
+from generate import tracks_to_piece, assemble_request, piece_to_track, generate, generate_bars, StubBackend, BACKENDS
+
+def synthetic_track(message_count, polyphony=8, ticks_per_beat=480, seed=0):
+    """
+    Build a delta-time MidiTrack of roughly message_count note messages with
+    up to polyphony notes held at once.
+    """
+    rng = random.Random(seed)
+    abs_messages = []
+    tick = 0
+
+    for _ in range(message_count // 2):
+        tick += rng.randrange(0, ticks_per_beat // 4 + 1)
+        pitch = rng.randrange(36, 96)
+        duration = rng.randrange(1, ticks_per_beat * polyphony // 4 + 2)
+        channel = rng.randrange(0, 16)
+        abs_messages.append((tick, mido.Message("note_on", channel=channel, note=pitch, velocity=rng.randrange(1, 128))))
+        abs_messages.append((tick + duration, mido.Message("note_off", channel=channel, note=pitch)))
+
+    abs_messages.sort(key=lambda m: m[0])
+
+    track = mido.MidiTrack()
+    prev_tick = 0
+    for tick, msg in abs_messages:
+        track.append(msg.copy(time=tick - prev_tick))
+        prev_tick = tick
+    track.append(mido.MetaMessage("end_of_track", time=0))
+
+    return track
+
+def loop_track(bars, notes_per_bar, ticks_per_beat=480, seed=0):
+    """
+    Build a Track of bars 4/4 bars with notes_per_bar single notes per bar.
+    """
+    rng = random.Random(seed)
+    bar_ticks = BEATS_PER_BAR * ticks_per_beat
+    abs_messages = []
+
+    for bar in range(bars):
+        for _ in range(notes_per_bar):
+            start = bar * bar_ticks + rng.randrange(0, bar_ticks)
+            end = min(start + rng.randrange(ticks_per_beat // 4, ticks_per_beat * 2), bars * bar_ticks)
+            pitch = rng.randrange(36, 96)
+            abs_messages.append((start, mido.Message("note_on", note=pitch, velocity=rng.randrange(1, 128))))
+            abs_messages.append((end, mido.Message("note_off", note=pitch)))
+
+    abs_messages.sort(key=lambda m: (m[0], m[1].type == "note_on"))
+
+    track = mido.MidiTrack()
+    prev_tick = 0
+    for tick, msg in abs_messages:
+        track.append(msg.copy(time=tick - prev_tick))
+        prev_tick = tick
+
+    return Track(track, ticks_per_beat)
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_track(sizes, polyphony, repeat):
+    print("Track construction")
+    print(f"{'messages':>10} {'seconds':>10} {'us/msg':>10}")
+
+    for size in sizes:
+        midi_track = synthetic_track(size, polyphony)
+        elapsed = best_of(repeat, Track, midi_track)
+        print(f"{len(midi_track):>10} {elapsed:>10.4f} {elapsed / len(midi_track) * 1e6:>10.2f}")
+
+GENERATION_STAGES = ("encode", "assemble", "sample", "decode")
+
+def generation_stages(tracks, beats, backend):
+    """
+    One generation of the last track, split into the stages of generate().
+    Yields each stage name once the stage is done.
+    """
+    active_track = len(tracks) - 1
+
+    piece = tracks_to_piece(tracks, beats)
+    yield "encode"
+
+    piece, status, param = assemble_request(piece, tracks, active_track)
+    yield "assemble"
+
+    midi_strs = backend.sample(piece, status, param, 3)
+    yield "sample"
+
+    for midi_str in midi_strs:
+        piece_to_track(json.loads(midi_str), active_track)
+    yield "decode"
+
+def measure_generation(tracks, beats, backend):
+    # timings and allocations are measured in separate runs, tracemalloc
+    # slows everything down
+    seconds = {}
+    start = time.perf_counter()
+    for stage in generation_stages(tracks, beats, backend):
+        now = time.perf_counter()
+        seconds[stage] = now - start
+        start = now
+
+    peaks = {}
+    tracemalloc.start()
+    for stage in generation_stages(tracks, beats, backend):
+        peaks[stage] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+    tracemalloc.stop()
+
+    return seconds, peaks
+
+def bench_generation(track_counts, bar_counts, densities, repeat, bar_delay=0.0):
+    """
+    Per-stage latency (best of repeat) and peak allocations of a generation
+    through the stub backend, over every combination of track count, bar
+    count and notes per bar.
+    """
+    backend = StubBackend(bar_delay=bar_delay)
+
+    print("Generation stages (stub backend, ms / peak KiB)")
+    header = f"{'tracks':>6} {'bars':>5} {'notes':>5}"
+    for stage in GENERATION_STAGES:
+        header += f" {stage:>16}"
+    print(header + f" {'total ms':>9}")
+
+    for track_count in track_counts:
+        for bar_count in bar_counts:
+            for density in densities:
+                tracks = [loop_track(bar_count, density, seed=i) for i in range(track_count)]
+                beats = bar_count * BEATS_PER_BAR
+
+                best = {}
+                peaks = {}
+                for _ in range(repeat):
+                    seconds, peaks = measure_generation(tracks, beats, backend)
+                    for stage, elapsed in seconds.items():
+                        best[stage] = min(best.get(stage, elapsed), elapsed)
+
+                row = f"{track_count:>6} {bar_count:>5} {density:>5}"
+                for stage in GENERATION_STAGES:
+                    row += f" {best[stage] * 1000:>8.2f}/{peaks[stage] / 1024:<7.0f}"
+                print(row + f" {sum(best.values()) * 1000:>9.2f}")
+
+def bench_streaming(bar_counts, track_count, density, repeat, backend):
+    """
+    One sample call for a whole bar selection against generate_bars, one
+    call per bar: time until the first bar can be heard and until the
+    selection is complete (best of repeat).
+    """
+    print(f"Streaming vs one call ({backend.name} backend, {track_count} tracks, {density} notes per bar)")
+    print(f"{'bars':>5} {'one call s':>11} {'stream first s':>15} {'stream total s':>15} {'overhead':>9}")
+
+    for bar_count in bar_counts:
+        tracks = [loop_track(bar_count, density, seed=i) for i in range(track_count)]
+        beats = bar_count * BEATS_PER_BAR
+
+        batch = first = total = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            generate(tracks, beats, 0, backend=backend)
+            batch = min(batch, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            bar_times = [time.perf_counter() - start for _ in generate_bars(tracks, beats, 0, backend=backend)]
+            first = min(first, bar_times[0])
+            total = min(total, bar_times[-1])
+
+        print(f"{bar_count:>5} {batch:>11.3f} {first:>15.3f} {total:>15.3f} {total / batch:>8.2f}x")
+
+class NullSynth:
+    """
+    Synth that only counts what it is asked to play.
+    """
+
+    def __init__(self):
+        self.messages = 0
+
+    def noteon(self, channel, note, velocity):
+        self.messages += 1
+
+    def noteoff(self, channel, note):
+        self.messages += 1
+
+    def pitch_bend(self, channel, pitch):
+        self.messages += 1
+
+    def cc(self, channel, control, value):
+        self.messages += 1
+
+    def all_notes_off(self, channel):
+        pass
+
+    def program_select(self, channel, sfid, bank, preset):
+        pass
+
+class NullMetronome:
+
+    def click(self, at=None):
+        pass
+
+    def clock(self, at=None):
+        pass
+
+    def cancel(self):
+        pass
+
+class FakeClock:
+    """
+    Stand-in for time.time that only moves when told to.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+def engine_session(track_count, bars, notes_per_bar):
+    """
+    A playing Looper with a null synth, a null metronome and a fake clock,
+    every track filled with notes_per_bar notes per bar.
+    """
+    from looper import Looper
+
+    clock = FakeClock()
+    looper = Looper(bpm=120, beats=bars * BEATS_PER_BAR, track_count=track_count,
+                    synth=NullSynth(), metronome=NullMetronome(), clock=clock)
+    looper.on_track_change = lambda track, track_number: None
+    looper.on_playhead_position_change = lambda position: None
+    looper.metronome_active = True
+
+    for i in range(track_count):
+        looper.setTrack(i, loop_track(bars, notes_per_bar, seed=i))
+
+    looper.start()
+    return looper, clock
+
+def bench_update(looper, clock, calls=2000):
+    # one GUI frame of playback per call
+    for _ in range(calls):
+        clock.advance(1 / 60)
+        start = time.perf_counter()
+        looper.update()
+        yield time.perf_counter() - start
+
+def bench_update_latency(looper, clock, calls=2000):
+    # the same with the latency monitor recording every event
+    import latency
+
+    latency.monitor.enable()
+    try:
+        yield from bench_update(looper, clock, calls)
+    finally:
+        latency.monitor.disable()
+        latency.monitor.reset()
+
+def bench_recording(looper, clock, calls=2000):
+    looper.recording = True
+    looper.setActiveTrack(0)
+    rng = random.Random(0)
+    for i in range(calls):
+        clock.advance(0.01)
+        looper.advance(clock())
+        pitch = rng.randrange(36, 96)
+        msg = mido.Message("note_on" if i % 2 == 0 else "note_off", note=pitch, velocity=100)
+        start = time.perf_counter()
+        looper.inputRecording(msg)
+        yield time.perf_counter() - start
+    looper.recording = False
+
+def bench_construction(looper, clock, calls=20):
+    midi_tracks = [track.midi_track for track in looper.tracks]
+    for _ in range(calls):
+        start = time.perf_counter()
+        for midi_track in midi_tracks:
+            Track(midi_track)
+        yield time.perf_counter() - start
+
+def bench_quantise(looper, clock, calls=20):
+    from midi import quantise
+
+    midi = mido.MidiFile(ticks_per_beat=480)
+    midi.tracks.extend(mido.MidiTrack(msg.copy() for msg in track.midi_track) for track in looper.tracks)
+    for _ in range(calls):
+        start = time.perf_counter()
+        quantise(midi, 4, 0.8, 0.1)
+        yield time.perf_counter() - start
+
+def bench_export(looper, clock, calls=20):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.mid")
+        for _ in range(calls):
+            start = time.perf_counter()
+            looper.export(path)
+            yield time.perf_counter() - start
+
+def bench_paint(looper, clock, calls=50, cold=False):
+    # offscreen Qt, no display needed
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    from timeline import Timeline
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    timeline = Timeline(looper.beats, len(looper.tracks))
+    timeline.resize(1200, 600)
+    for i, track in enumerate(looper.tracks):
+        timeline.setTrack(track, i)
+    timeline.grab()
+
+    for _ in range(calls):
+        if cold:
+            for i in range(len(looper.tracks)):
+                timeline.invalidateLayer(i)
+        start = time.perf_counter()
+        timeline.grab()
+        yield time.perf_counter() - start
+
+ENGINE_BENCHMARKS = {
+    "update": bench_update,
+    "update_latency": bench_update_latency,
+    "record": bench_recording,
+    "track": bench_construction,
+    "quantise": bench_quantise,
+    "export": bench_export,
+    "paint": bench_paint,
+    "paint_cold": lambda looper, clock: bench_paint(looper, clock, cold=True),
+}
+
+def run_engine_benchmark(name, track_count, bars, notes_per_bar):
+    """
+    Time every call of one benchmark on a fresh session, then run it again
+    under tracemalloc for its peak allocations.
+    """
+    benchmark = ENGINE_BENCHMARKS[name]
+
+    # the looper prints a lot, keep it out of the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        looper, clock = engine_session(track_count, bars, notes_per_bar)
+        seconds = np.array(list(benchmark(looper, clock)))
+
+        looper, clock = engine_session(track_count, bars, notes_per_bar)
+        tracemalloc.start()
+        for _ in benchmark(looper, clock):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'benchmark': name,
+        'tracks': track_count,
+        'bars': bars,
+        'notes_per_bar': notes_per_bar,
+        'calls': len(seconds),
+        'per_second': len(seconds) / seconds.sum() if seconds.sum() > 0 else None,
+        'p50_us': float(np.percentile(seconds, 50) * 1e6),
+        'p99_us': float(np.percentile(seconds, 99) * 1e6),
+        'peak_kib': peak / 1024,
+    }
+
+def bench_engine(track_counts, bar_counts, densities, names=None):
+    """
+    The Looper engine benchmarks over every combination of track count,
+    loop length in bars and notes per bar, headless. Returns one result
+    dict per run.
+    """
+    names = names or list(ENGINE_BENCHMARKS)
+    results = []
+
+    print("Looper engine")
+    print(f"{'benchmark':>14} {'tracks':>6} {'bars':>5} {'notes':>5} {'calls/s':>10} {'p50 us':>10} {'p99 us':>10} {'peak KiB':>9}")
+
+    for name in names:
+        for track_count in track_counts:
+            for bars in bar_counts:
+                for density in densities:
+                    result = run_engine_benchmark(name, track_count, bars, density)
+                    results.append(result)
+                    print(f"{name:>14} {track_count:>6} {bars:>5} {density:>5} {result['per_second'] or 0:>10.0f} "
+                          f"{result['p50_us']:>10.1f} {result['p99_us']:>10.1f} {result['peak_kib']:>9.0f}")
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AI Looper benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--polyphony", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tracks", type=int, nargs="+", default=[2, 8])
+    parser.add_argument("--bars", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--density", type=int, nargs="+", default=[4, 32], help="notes per bar")
+    parser.add_argument("--bar-delay", type=float, default=0.0, help="seconds the stub model spends per bar")
+    parser.add_argument("--suite", nargs="+", choices=["track", "generation", "streaming", "engine"],
+                        default=["track", "generation", "engine"])
+    parser.add_argument("--backend", choices=list(BACKENDS), default="stub", help="model for the streaming suite")
+    parser.add_argument("--call-delay", type=float, default=0.0, help="seconds the stub model spends per call")
+    parser.add_argument("--engine", nargs="+", choices=list(ENGINE_BENCHMARKS), default=None, help="engine benchmarks to run")
+    parser.add_argument("--json", help="write the engine results to this file as JSON")
+    args = parser.parse_args()
+
+    if "track" in args.suite:
+        bench_track(args.sizes, args.polyphony, args.repeat)
+        print()
+    if "generation" in args.suite:
+        bench_generation(args.tracks, args.bars, args.density, args.repeat, args.bar_delay)
+        print()
+    if "streaming" in args.suite:
+        backend = StubBackend(args.bar_delay, call_delay=args.call_delay) if args.backend == "stub" else BACKENDS[args.backend]()
+        bench_streaming(args.bars, args.tracks[0], args.density[0], args.repeat, backend)
+        print()
+    if "engine" in args.suite:
+        results = bench_engine(args.tracks, args.bars, args.density, args.engine)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
@@ -9,7 +9,8 @@ class MIDIListener:
     def deviceListUpdated(self, devices):
         pass
     
-    def midiEvent(self, msg):
+    def midiEvent(self, msg, received=None):
+        # received is the time.perf_counter() the message arrived
         pass
     
     def notifyDeviceRemoved(self, removed_device):
@@ -74,7 +75,7 @@ class MIDIDeviceMonitor:
     
     def listen_for_midi_events(self):
         for msg in self.midi_input:
-            self.window.midiEvent(msg)
+            self.window.midiEvent(msg, time.perf_counter())
     
     def run(self):
         
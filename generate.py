@@ -1,168 +1,250 @@
 import json
-import midigpt
 import os
+import sys
+import hashlib
+import math
+import time
+import random
+import queue
+import multiprocessing
 import mido
-from midi import is_empty_track
+from collections import OrderedDict
+import numpy as np
+from midi import Track, NOTE_DTYPE, BEATS_PER_BAR
+from session import SessionSnapshot, SharedSnapshot, SnapshotTrack
 
-def generate_task(queue, looper):
-    midi_input = "midi/input.mid"
-    midi_dest = "midi/output.mid"
+# imported on first use by load_midigpt, the GUI process never needs it
+midigpt = None
+MIDIGPT_PATH = "midigpt_workspace/MIDI-GPT/python_lib"
 
-    e = midigpt.ExpressiveEncoder()
-    m2j = None
-    try:
-        m2j = e.midi_to_json(midi_input)
+def load_midigpt():
+    """
+    Import midigpt (and with it libtorch) the first time it is needed.
+    Returns None if it is not installed, only the stub backend can run then.
+    """
+    global midigpt
+    if midigpt is None:
+        if MIDIGPT_PATH not in sys.path:
+            sys.path.append(MIDIGPT_PATH)
+        try:
+            import midigpt as module
+        except ImportError:
+            return None
+        midigpt = module
+    return midigpt
 
-    except RuntimeError:
-        print("Error converting MIDI to JSON")
-        return            
-    
-    midi_json_input = json.loads(m2j)
-    #print("Exporting to", midi_input)
-    
-    midi_file = mido.MidiFile()
-    midi_file.ticks_per_beat = 480
-    for i, track in enumerate(looper.tracks):
+CKPT = "midigpt_workspace/MIDI-GPT/models/EXPRESSIVE_ENCODER_RES_1920_12_GIGAMIDI_CKPT_150K.pt"
+
+# ticks per beat of the piece JSON sent to the model (its resolution field)
+PIECE_RESOLUTION = 12
+
+# bars the model attends to at once (model_dim), a step never spans more
+MODEL_DIM = 4
+
+def loop_bars(beats):
+    return max(1, math.ceil(beats / BEATS_PER_BAR))
+
+def selection_beats(bars, beats):
+    """
+    The (start, end) beats of a bar range, None meaning the whole loop.
+    """
+    first_bar, end_bar = clamp_bars(bars, loop_bars(beats))
+    return first_bar * BEATS_PER_BAR, min(end_bar * BEATS_PER_BAR, beats)
+
+def context_notes(notes, start, end):
+    """
+    The notes of a regenerated track that condition the model: those
+    starting in [start, end) beats are dropped, and those held into it are
+    cut off at start, as splice_bars will leave them.
+    """
+    starts = notes["start"]
+    context = notes[(starts < start) | (starts >= end)].copy()
+    held = (context["start"] < start) & (context["start"] + context["duration"] > start)
+    context["duration"][held] = start - context["start"][held]
+    return context
+
+def tracks_to_piece(tracks, beats, bpm=120, bars=None, selected_tracks=None):
+    """
+    Encode looper tracks straight into a MIDI-GPT piece dict, one piece track
+    per looper track (empty tracks get empty bars) so track ids line up.
+
+    Every note becomes an onset event (velocity > 0) in the bar it starts in
+    and an offset event (velocity 0) in the bar it ends in, with times in
+    PIECE_RESOLUTION ticks from the start of the bar. Bars hold indices into
+    the piece's event list. Notes are clipped to the loop, and on the
+    selected_tracks to the context outside bars (see context_notes), so no
+    note is left open in a bar the model rewrites.
+    """
+    bar_ticks = BEATS_PER_BAR * PIECE_RESOLUTION
+    loop_ticks = int(round(beats * PIECE_RESOLUTION))
+    bar_count = loop_bars(beats)
+    selected_tracks = set(selected_tracks or ())
+    selection = selection_beats(bars, beats)
         
-        midi_track = mido.MidiTrack()
-        midi_track.name = f"Track {i}"
+    events = []
+    piece_tracks = []
         
-        if track is None or is_empty_track(track.midi_track):
-            print(f"Exporting empty track {i}")
+    for index, track in enumerate(tracks):
             
-            #midi_track.append(mido.Message("note_on", note=60, velocity=1, time=0))
-            #midi_track.append(mido.Message("note_off", note=60, velocity=0, time=1))
+        piece_bars = [{'events': [], 'ts_numerator': 4, 'ts_denominator': 4} for _ in range(bar_count)]
+        piece_tracks.append({'instrument': 0, 'track_type': 10, 'bars': piece_bars})
 
-        else:
-            # convert the track to 480 ticks per beat
-            print(f"Exporting track {i}")
+        if track is None:
+            continue
             
-            for msg in track.midi_track:
+        notes = track.note_array
+        if index in selected_tracks:
+            notes = context_notes(notes, *selection)
+        starts = [int(round(start * PIECE_RESOLUTION)) for start in notes["start"].tolist()]
+        ends = [int(round(end * PIECE_RESOLUTION)) for end in (notes["start"] + notes["duration"]).tolist()]
                 
+        # the model reads a bar's events in time order
+        onsets = [[] for _ in range(bar_count)]
+        offsets = [[] for _ in range(bar_count)]
                 
-                beats = msg.time / track.ticks_per_beat
-                if beats > looper.beats:
-                    print(f"Breaking at {beats} beats")
-                    break
+        for start, end, pitch, velocity in zip(starts, ends, notes["pitch"].tolist(), notes["velocity"].tolist()):
+            if start >= loop_ticks:
+                continue
+            end = min(max(end, start + 1), loop_ticks)
                 
-                ticks = int(beats * midi_file.ticks_per_beat)
-                midi_track.append(msg.copy(time=ticks))
+            onsets[start // bar_ticks].append((start % bar_ticks, pitch, velocity))
         
-            # add a dummy note to the track
+            # a note ending on a bar line ends at the end of the previous bar
+            end_bar = (end - 1) // bar_ticks
+            offsets[end_bar].append((end - end_bar * bar_ticks, pitch, 0))
 
-        midi_file.tracks.append(midi_track)
+        for bar, bar_onsets, bar_offsets in zip(piece_bars, onsets, offsets):
+            for time, pitch, velocity in sorted(bar_offsets + bar_onsets, key=lambda e: (e[0], e[2] > 0)):
+                bar['events'].append(len(events))
+                events.append({'time': time, 'velocity': velocity, 'pitch': pitch})
         
-    print("Exported MIDI file:")
-    print(f"Track count: {len(midi_file.tracks)}")
+    return {
+        'tracks': piece_tracks,
+        'events': events,
+        'resolution': PIECE_RESOLUTION,
+        'tempo': int(bpm)
+    }
         
-    midi_file.save(midi_input)
+def piece_to_track(piece, track_index, ticks_per_beat=480):
+    """
+    Decode one track of a MIDI-GPT piece dict straight into a looper Track,
+    using the piece's own resolution and time signatures. Offsets without a
+    note are dropped and notes the model never ended end with the piece.
+    """
+    resolution = piece.get('resolution', PIECE_RESOLUTION)
+    events = piece['events']
 
-    bars = 8
-    
-    # add back in the empty tracks
-    for index in range(len(midi_json_input['tracks'])):
-        
-        bars = len(midi_json_input['tracks'][index]['bars'])
-        print(f"Track {index} has {bars} bars")
-    
-    # add back in the empty tracks
-    for index in range(len(looper.tracks)):
-        if looper.tracks[index] is None or is_empty_track(looper.tracks[index].midi_track):
-            print(f"Adding empty track {index}")
-            midi_json_input['tracks'].insert(index, {
-                'instrument': 0,
-                'track_type': 10,
-                'bars': [{'events': [], 'ts_numerator': 4, 'ts_denominator': 4} for _ in range(bars)]
-            })
-            
-    
-    num_tracks = len(midi_json_input['tracks'])
-    print(f"Number of tracks: {num_tracks}")
+    abs_messages = []
+    bar_start = 0
+
+    for bar in piece['tracks'][track_index]['bars']:
+
+        for index in bar.get('events', []):
+            event = events[index]
+            ticks = int(round((bar_start + event.get('time', 0)) / resolution * ticks_per_beat))
+            velocity = event.get('velocity', 0)
+            message_type = "note_on" if velocity > 0 else "note_off"
+            abs_messages.append((ticks, velocity > 0, mido.Message(message_type, note=event['pitch'], velocity=velocity)))
+
+        beats_per_bar = 4 * bar.get('ts_numerator', 4) / bar.get('ts_denominator', 4)
+        bar_start += beats_per_bar * resolution
+
+    if not abs_messages:
+        return None
+
+    # offsets before onsets at the same tick so repeated notes pair up
+    abs_messages.sort(key=lambda m: (m[0], m[1]))
+
+    end_ticks = int(round(bar_start / resolution * ticks_per_beat))
+    midi_track = mido.MidiTrack()
+    held = {}
+    prev_ticks = 0
+    for ticks, onset, msg in abs_messages:
+        if onset:
+            held[msg.note] = held.get(msg.note, 0) + 1
+        elif held.get(msg.note, 0) > 0:
+            held[msg.note] -= 1
+        else:
+            continue
+        midi_track.append(msg.copy(time=ticks - prev_ticks))
+        prev_ticks = ticks
+
+    for pitch, count in held.items():
+        for _ in range(count):
+            midi_track.append(mido.Message("note_off", note=pitch, velocity=0, time=max(0, end_ticks - prev_ticks)))
+            prev_ticks = max(prev_ticks, end_ticks)
+
+    return Track(midi_track, ticks_per_beat)
+
+def build_request(tracks, beats, active_track, bpm=120, batch_size=1, seed=-1, bars=None, selected_tracks=None):
+    """
+    Build the piece, status and param JSON strings for sample_multi_step.
+
+    The bars first <= bar < end of bars = (first, end) are regenerated on
+    every track in selected_tracks, everything else is context. By default
+    every bar of the active track is regenerated. The model steps over the
+    selection only, bars_per_step and tracks_per_step are sized to it, so a
+    small selection is a single short step. batch_size variations are
+    sampled in the same inference call; seed -1 samples randomly.
+    """
+    if selected_tracks is None:
+        selected_tracks = [active_track]
+    midi_json_input = tracks_to_piece(tracks, beats, bpm, bars, selected_tracks)
+    return assemble_request(midi_json_input, tracks, active_track, batch_size, seed, bars, selected_tracks)
+
+def assemble_request(midi_json_input, tracks, active_track, batch_size=1, seed=-1, bars=None, selected_tracks=None):
+    """
+    Second half of build_request: the status and param for an already
+    encoded piece, and all three serialised.
+    """
+    bar_count = len(midi_json_input['tracks'][0]['bars']) if midi_json_input['tracks'] else 0
+    first_bar, end_bar = clamp_bars(bars, bar_count)
+
+    if selected_tracks is None:
+        selected_tracks = [active_track]
+    selected_tracks = sorted(set(selected_tracks))
     
     valid_status = {
         'tracks': []
     }
     
-    track_id = 0
-    active_track_id = -1
+    for track_id in range(len(tracks)):
     
-    for index in range(len(looper.tracks)):
+        is_selected = track_id in selected_tracks
+        empty_track = tracks[track_id] is None or len(tracks[track_id].note_array) == 0
     
-        active_track = index == looper.active_track
-        empty_track = looper.tracks[index] == None or is_empty_track(looper.tracks[index].midi_track)
-        #empty_track = False
-        print(f"Assembling track {index}, active: {active_track}, empty: {empty_track}")
-
-            
-        if active_track:
-            
-            active_track_id = track_id
-            
-            valid_status['tracks'].append({
-                'track_id': active_track_id,
-                'temperature': 0.5,
-                'instrument': 'no_drums',
-                'density': 10,
-                'track_type': 10, #STANDARD_TRACK
-                'ignore': False,
-                'selected_bars': [True] * bars,
-                'min_polyphony_q': 'POLYPHONY_ANY',
-                'max_polyphony_q': 'POLYPHONY_ANY',
-                'autoregressive': False,
-                'polyphony_hard_limit': 9
-            })
-            
-            track_id += 1
-            
-        elif empty_track:
-        
-            valid_status['tracks'].append({
-                'track_id': track_id,
-                'temperature': 0.5,
-                'instrument': 'no_drums',
-                'density': 10,
-                'track_type': 10,
-                'ignore': True,
-                'selected_bars': [False] * bars,
-                'min_polyphony_q': 'POLYPHONY_ANY',
-                'max_polyphony_q': 'POLYPHONY_ANY',
-                'autoregressive': False,
-                'polyphony_hard_limit': 9
-            })
-            
-            track_id += 1
-        
+        if is_selected:
+            selected_bars = [first_bar <= bar < end_bar for bar in range(bar_count)]
         else:
+            selected_bars = [False] * bar_count
             
-            valid_status['tracks'].append({
-                'track_id': track_id,
-                'temperature': 0.5,
-                'instrument': 'no_drums',
-                'density': 10,
-                'track_type': 10,
-                'ignore': False,
-                'selected_bars': [False] * bars,
-                'min_polyphony_q': 'POLYPHONY_ANY',
-                'max_polyphony_q': 'POLYPHONY_ANY',
-                'autoregressive': False,
-                'polyphony_hard_limit': 9
-            })
-            
-            track_id += 1
+        valid_status['tracks'].append({
+            'track_id': track_id,
+            'temperature': 0.5,
+            'instrument': 'no_drums',
+            'density': 10,
+            'track_type': 10, #STANDARD_TRACK
+            'ignore': empty_track and not is_selected,
+            'selected_bars': selected_bars,
+            'min_polyphony_q': 'POLYPHONY_ANY',
+            'max_polyphony_q': 'POLYPHONY_ANY',
+            'autoregressive': False,
+            'polyphony_hard_limit': 9
+        })
 
     parami={
-      'tracks_per_step': 1, 
-      'bars_per_step': 1, 
-      'model_dim': 4, 
+      'tracks_per_step': max(1, len(selected_tracks)),
+      'bars_per_step': max(1, min(end_bar - first_bar, MODEL_DIM)),
+      'model_dim': MODEL_DIM,
       'percentage': 100, 
-      'batch_size': 1, 
+      'batch_size': batch_size,
       'temperature': 1.0, 
       'max_steps': 200, 
       'polyphony_hard_limit': 6, 
       'shuffle': True, 
       'verbose': False, 
-      'ckpt': "midigpt_workspace/MIDI-GPT/models/EXPRESSIVE_ENCODER_RES_1920_12_GIGAMIDI_CKPT_150K.pt",
-      'sampling_seed': -1,
+      'ckpt': CKPT,
+      'sampling_seed': seed,
       'mask_top_k': 0
     }
 
@@ -170,13 +252,923 @@ def generate_task(queue, looper):
     status = json.dumps(valid_status)
     param = json.dumps(parami)
 
-    callbacks = midigpt.CallbackManager()
+    return piece, status, param
+
+def clamp_bars(bars, bar_count):
+    """
+    Clamp a (first, end) bar range to the loop, None meaning every bar.
+    """
+    if bars is None:
+        return 0, bar_count
+    first, end = bars
+    first = min(max(0, first), bar_count - 1)
+    end = min(max(first + 1, end), bar_count)
+    return first, end
+
+class ResultCache:
+    """
+    Content-addressed cache of sample_multi_step results, keyed by a hash of
+    the piece, status and param JSON. Only seeded requests are cached, a
+    random seed gives a different answer every time; in the GUI that means
+    choosing a seed in the seed box.
+
+    Entries are kept in memory (the max_entries most recently used) and as
+    JSON files in directory, where the least recently used files are deleted
+    once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory="midigpt_cache", max_entries=64, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def key(self, piece, status, param):
+        if json.loads(param).get('sampling_seed', -1) == -1:
+            return None
+        digest = hashlib.sha256()
+        for part in (piece, status, param):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        os.utime(path)      # the mtime orders files for eviction
+        self.remember(key, value)
+        self.hits += 1
+        self.disk_hits += 1
+        return value
+
+    def put(self, key, value):
+        self.remember(key, value)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(key), "w") as f:
+                json.dump(value, f)
+            self.evict()
+        except OSError as e:
+            print(f"Could not write generation cache: {e}")
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def evict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        files.sort()
+        while total > self.max_bytes and files:
+            _, size, path = files.pop(0)
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'uncacheable': self.uncacheable,
+            'entries': len(self.entries)
+        }
+
+class MidiGPTBackend:
+    """
+    Generation backend running the MIDI-GPT checkpoint through midigpt.
+
+    midigpt has no loaded-model handle: sample_multi_step takes the
+    checkpoint path in param on every call, and whether it keeps the model
+    between calls is up to midigpt. A long-lived worker only saves the
+    import, the libtorch start-up and whatever midigpt itself keeps.
+
+    A backend takes the piece, status and param JSON strings and returns
+    one piece JSON string per variation, and wraps a ProgressCallback in
+    whatever its sampler expects.
+    """
+
+    name = "midigpt"
+
+    def sample(self, piece, status, param, max_attempts, callbacks=None):
+        if load_midigpt() is None:
+            raise RuntimeError("midigpt is not installed")
+        if callbacks is None:
+            callbacks = midigpt.CallbackManager()
+        return list(midigpt.sample_multi_step(piece, status, param, max_attempts, callbacks))
+
+    def callbacks(self, callback):
+        return make_callbacks(callback)
+
+class StubBackend:
+    """
+    Deterministic stand-in for the model, for benchmarks and machines without
+    midigpt or the checkpoint. Every selected bar gets an arpeggio picked
+    from the seed, variation, track and bar, after sleeping bar_delay
+    seconds to stand in for inference, plus call_delay once per call for
+    the model's fixed cost. Random seeds (-1) are treated as 0.
+    """
+
+    name = "stub"
+
+    def __init__(self, bar_delay=0.0, notes_per_bar=8, call_delay=0.0):
+        self.bar_delay = bar_delay
+        self.notes_per_bar = notes_per_bar
+        self.call_delay = call_delay
+
+    def sample(self, piece, status, param, max_attempts, callbacks=None):
+        if self.call_delay:
+            time.sleep(self.call_delay)
+        status = json.loads(status)
+        param = json.loads(param)
+        seed = max(0, param.get('sampling_seed', -1))
+
+        midi_strs = []
+        for variation in range(param.get('batch_size', 1)):
+            output = json.loads(piece)
+            resolution = output.get('resolution', PIECE_RESOLUTION)
+
+            for track_status in status['tracks']:
+                track_id = track_status['track_id']
+
+                for bar_index, selected in enumerate(track_status['selected_bars']):
+                    if not selected:
+                        continue
+                    if callbacks is not None and callbacks.is_cancelled():
+                        raise GenerationCancelled()
+                    if self.bar_delay:
+                        time.sleep(self.bar_delay)
+
+                    bar = output['tracks'][track_id]['bars'][bar_index]
+                    bar['events'] = self.arpeggio(output['events'], bar, resolution, (seed, variation, track_id, bar_index))
+
+                    if callbacks is not None:
+                        callbacks.on_bar_end()
+
+            midi_strs.append(json.dumps(output))
+
+        return midi_strs
+
+    def arpeggio(self, events, bar, resolution, key):
+        rng = random.Random(repr(key))
+        root = rng.randrange(48, 72)
+        chord = rng.choice(((0, 4, 7, 12), (0, 3, 7, 10), (0, 5, 7, 12)))
+        bar_ticks = int(4 * bar.get('ts_numerator', 4) / bar.get('ts_denominator', 4) * resolution)
+        step = max(1, bar_ticks // self.notes_per_bar)
+
+        indices = []
+        for i in range(self.notes_per_bar):
+            if (i + 1) * step > bar_ticks:
+                break
+            pitch = root + chord[i % len(chord)]
+            for time, velocity in ((i * step, rng.randrange(60, 110)), ((i + 1) * step, 0)):
+                indices.append(len(events))
+                events.append({'time': time, 'velocity': velocity, 'pitch': pitch})
+        return indices
+
+    def callbacks(self, callback):
+        return callback
+
+BACKENDS = {
+    'midigpt': MidiGPTBackend,
+    'stub': StubBackend,
+}
+
+default_backend = MidiGPTBackend()
+
+def sample(piece, status, param, max_attempts, callbacks, cache=None, cancelled=None, backend=None):
+    """
+    Sample through a backend (MIDI-GPT by default) and an optional
+    ResultCache. Results of a run for which cancelled() is true may be
+    partial and are not stored.
+    """
+    if backend is None:
+        backend = default_backend
+
+    key = cache.key(piece, status, param) if cache is not None else None
+    if key is not None:
+        key = f"{backend.name}-{key}"
+
+    if key is None:
+        if cache is not None:
+            cache.uncacheable += 1
+        return backend.sample(piece, status, param, max_attempts, callbacks)
+
+    midi_strs = cache.get(key)
+    if midi_strs is None:
+        midi_strs = backend.sample(piece, status, param, max_attempts, callbacks)
+        if cancelled is None or not cancelled():
+            cache.put(key, midi_strs)
+
+    return midi_strs
+
+def generate(tracks, beats, active_track, bpm=120, batch_size=1, callbacks=None, seed=-1, cache=None, cancelled=None,
+             bars=None, selected_tracks=None, backend=None):
+    """
+    Regenerate the selected bars of the selected tracks (by default all of
+    the active track) entirely in memory. Returns a list of batch_size
+    candidates, each a dict of track index -> Track (None where the model
+    left the track empty). Unselected bars come back as they were sent.
+    """
+    piece, status, param = build_request(tracks, beats, active_track, bpm, batch_size, seed, bars, selected_tracks)
     max_attempts = 3
 
-    midi_str = midigpt.sample_multi_step(piece, status, param, max_attempts, callbacks)[0]
-    midi_json = json.loads(midi_str)
+    midi_strs = sample(piece, status, param, max_attempts, callbacks, cache, cancelled, backend)
+
+    if selected_tracks is None:
+        selected_tracks = [active_track]
+
+    candidates = []
+    for midi_str in midi_strs:
+        piece = json.loads(midi_str)
+        candidates.append({index: piece_to_track(piece, index) for index in selected_tracks})
+
+    return candidates
+
+def generate_bars(tracks, beats, active_track, bpm=120, callbacks=None, seed=-1, cache=None, cancelled=None,
+                  bars=None, selected_tracks=None, backend=None):
+    """
+    Streaming version of generate: samples the selection one bar at a time,
+    each step taking the bars already generated as context, and yields
+    (bar, candidate) as soon as each bar is done. The candidate holds the
+    selected tracks with every bar up to and including bar regenerated.
+
+    The old notes of the whole selection are left out of the context from
+    the first step, as generate leaves them out, so no bar is conditioned
+    on the material it replaces.
+    """
+    tracks = list(tracks)
+    first_bar, end_bar = clamp_bars(bars, loop_bars(beats))
+    selection = selection_beats((first_bar, end_bar), beats)
+
+    if selected_tracks is None:
+        selected_tracks = [active_track]
+
+    for index in selected_tracks:
+        notes = tracks[index].note_array if tracks[index] is not None else np.empty(0, dtype=NOTE_DTYPE)
+        tracks[index] = SnapshotTrack(context_notes(notes, *selection))
+
+    for bar in range(first_bar, end_bar):
+        if cancelled is not None and cancelled():
+            return
+
+        bar_seed = seed if seed == -1 else seed + bar
+        candidate = generate(tracks, beats, active_track, bpm, 1, callbacks, bar_seed, cache, cancelled,
+                             (bar, bar + 1), selected_tracks, backend)[0]
+
+        for track_index, track in candidate.items():
+            tracks[track_index] = track
+
+        yield bar, candidate
+
+def session_key(tracks, beats, active_track, bpm=120, bars=None, selected_tracks=None, seed=-1):
+    """
+    Hash of what a generation depends on: the loop length, tempo, seed, the
+    selection and the notes the model is conditioned on. On the selected
+    tracks that is only their context outside the selected bars, so
+    installing a variation, which rewrites just those bars, keeps the key.
+    """
+    if selected_tracks is None:
+        selected_tracks = [active_track]
+    selected_tracks = sorted(set(selected_tracks))
+    bars = clamp_bars(bars, loop_bars(beats))
+    selection = selection_beats(bars, beats)
+
+    digest = hashlib.sha1()
+    digest.update(repr((beats, bpm, len(tracks), selected_tracks, bars, seed)).encode())
+
+    for index, track in enumerate(tracks):
+        if index in selected_tracks:
+            notes = track.note_array if track is not None else np.empty(0, dtype=NOTE_DTYPE)
+            digest.update(b"|" + context_notes(notes, *selection).tobytes())
+        elif track is None:
+            digest.update(b"-")
+        else:
+            digest.update(b"|" + track.note_array.tobytes())
+
+    return digest.hexdigest()
+
+def splice_bars(original, generated, bars, beats):
+    """
+    A new Track holding the original with the notes of the bars
+    first <= bar < end of bars = (first, end) replaced by the notes
+    generated there. Every other event of the original is kept exactly as
+    it was, including control changes inside the bars. Original notes held
+    into the bars end where they start and generated notes still held at
+    the end of them end there, so nothing is left sounding. A kept note
+    held over the loop end keeps its note-off after the wrap.
+    """
+    ticks_per_beat = original.ticks_per_beat if original is not None else 480
+    start_beat, end_beat = selection_beats(bars, beats)
+    start, end = int(round(start_beat * ticks_per_beat)), int(round(end_beat * ticks_per_beat))
+
+    def is_note(msg):
+        return msg.type == "note_on" or msg.type == "note_off"
+
+    def is_onset(msg):
+        return msg.type == "note_on" and msg.velocity > 0
+
+    messages = []           # (ticks, msg), sorted at the end
+    held = {}               # (channel, pitch) -> notes held, of the source being copied
+
+    def close_held(ticks):
+        for (channel, pitch), count in held.items():
+            for _ in range(count):
+                messages.append((ticks, mido.Message("note_off", channel=channel, note=pitch, velocity=0)))
+        held.clear()
+
+    def keep_note(ticks, msg):
+        key = (msg.channel, msg.note)
+        if is_onset(msg):
+            held[key] = held.get(key, 0) + 1
+        elif held.get(key, 0) > 0:
+            held[key] -= 1
+        else:
+            return      # its note-on was in the replaced bars
+        messages.append((ticks, msg))
+
+    end_of_track = None
+    if original is not None:
+        # notes after the bars that are still held at the loop end sound
+        # from the start of the loop until their wrapped note-off
+        for key, notes in original.notes_on.items():
+            wrapped = sum(1 for note in notes if note.start >= end_beat)
+            if wrapped:
+                held[key] = wrapped
+
+        closed = False
+        for ticks, msg in zip(original.abs_ticks, original.midi_track):
+            if not closed and ticks >= start:
+                close_held(start)
+                closed = True
+            if msg.type == "end_of_track":
+                end_of_track = (ticks, msg)
+            elif not is_note(msg):
+                messages.append((ticks, msg))
+            elif ticks < start or ticks >= end:
+                keep_note(ticks, msg)
+        if not closed:
+            close_held(start)
+        held.clear()
+
+    if generated is not None:
+        for beat, msg in zip(generated.event_beats, generated.events):
+            ticks = int(round(beat * ticks_per_beat))
+            if is_note(msg) and start <= ticks < end:
+                keep_note(ticks, msg)
+        close_held(end)
+
+    # note-offs first at the same tick, so a repeated note is not cut short
+    messages.sort(key=lambda m: (m[0], is_onset(m[1])))
+    if end_of_track is not None:
+        messages.append((max(end_of_track[0], messages[-1][0] if messages else 0), end_of_track[1]))
+
+    midi_track = mido.MidiTrack()
+    prev_ticks = 0
+    for ticks, msg in messages:
+        midi_track.append(msg.copy(time=ticks - prev_ticks))
+        prev_ticks = ticks
+
+    return Track(midi_track, ticks_per_beat)
+
+class CandidateCache:
+    """
+    Generated variations per session key, so the GUI can step through them
+    without waiting on the model. Keeps the most recently used max_sessions
+    sessions.
+    """
+
+    def __init__(self, max_sessions=8):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()       # key -> [candidates, index of the next one]
+
+    def add(self, key, candidates):
+        entry = self.sessions.get(key)
+        if entry is None:
+            entry = self.sessions[key] = [[], 0]
+        entry[0].extend(candidates)
+        self.sessions.move_to_end(key)
+
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def next(self, key):
+        """
+        Return the next candidate (track index -> Track) for key, wrapping
+        round once every candidate has been seen, or None if there are none.
+        The tracks are shared with the cache: install them by splicing into
+        a new track, never by recording into them.
+        """
+        entry = self.sessions.get(key)
+        if entry is None or not entry[0]:
+            return None
+
+        candidates, index = entry
+        if index >= len(candidates):
+            index = 0
+        entry[1] = index + 1
+        self.sessions.move_to_end(key)
+
+        return candidates[index]
+
+    def remaining(self, key):
+        """
+        Number of candidates for key not shown yet.
+        """
+        entry = self.sessions.get(key)
+        if entry is None:
+            return 0
+        return max(0, len(entry[0]) - entry[1])
+
+def warm_up(backend=None):
+    """
+    Run one small generation so libtorch is started, and the checkpoint
+    loaded if midigpt keeps it between calls, before the first real request.
+    A restarted worker warms up again.
+    """
+    context = mido.MidiTrack()
+    for beat in range(4):
+        context.append(mido.Message("note_on", note=60 + beat, velocity=80, time=0 if beat == 0 else 240))
+        context.append(mido.Message("note_off", note=60 + beat, velocity=0, time=240))
+
+    generate([Track(context), None], 4, 1, backend=backend)
+
+class GenerationCancelled(Exception):
+    pass
+
+class ProgressCallback:
+    """
+    Sampling callback that streams progress for one request back to the GUI
+    and asks the model to stop once the request is cancelled or its deadline
+    has passed. Backends wrap it in whatever their sampler calls.
+    """
+
+    def __init__(self, request_id, results, cancel_before, deadline=None, interval=0.1):
+        self.request_id = request_id
+        self.results = results
+        self.cancel_before = cancel_before      # shared value, requests below it are cancelled
+        self.deadline = deadline
+        self.interval = interval
+
+        self.start_time = time.time()
+        self.last_report = 0
+        self.bars = 0
+        self.tokens = 0
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        self.results.put(("progress", self.request_id, {
+            'bars': self.bars, 
+            'tokens': self.tokens, 
+            'elapsed': now - self.start_time
+        }))
+
+    def on_start(self, *args):
+        self.report(force=True)
+
+    def on_bar_end(self, *args):
+        self.bars += 1
+        self.report(force=True)
+
+    def on_prediction(self, *args):
+        self.tokens += 1
+        self.report()
+
+    def is_cancelled(self, *args):
+        if self.request_id < self.cancel_before.value:
+            return True
+        return self.deadline is not None and time.time() > self.deadline
+
+midigpt_callback_class = None
+
+def midigpt_callback(callback):
+    """
+    Wrap a ProgressCallback in a midigpt.Callback subclass, built once
+    midigpt has been imported.
+    """
+    global midigpt_callback_class
+    if midigpt_callback_class is None:
+
+        class MidiGPTCallback(getattr(midigpt, "Callback", object)):
+            def __init__(self, callback):
+                super().__init__()
+                self.callback = callback
+
+            def on_start(self, *args):
+                self.callback.on_start(*args)
+
+            def on_bar_end(self, *args):
+                self.callback.on_bar_end(*args)
+
+            def on_prediction(self, *args):
+                self.callback.on_prediction(*args)
+
+            def is_cancelled(self, *args):
+                return self.callback.is_cancelled(*args)
+
+        midigpt_callback_class = MidiGPTCallback
+
+    return midigpt_callback_class(callback)
+
+def make_callbacks(callback):
+    callbacks = load_midigpt().CallbackManager()
+    # the manager may only hold a pointer, the ProgressCallback keeps the wrapper alive
+    wrapper = midigpt_callback(callback)
+    callback.wrapper = wrapper
+    callback = wrapper
+    for name in ("add_callback_ptr", "add_callback"):
+        add = getattr(callbacks, name, None)
+        if add is not None:
+            add(callback)
+            break
+    return callbacks
+
+def run_request(request_id, session, results, callback, cache, backend):
+    """
+    Generate the candidates of one request from its session snapshot,
+    mapping the snapshot's shared memory only for as long as it is read.
+    """
+    handle = session["snapshot"]
+    snapshot = handle.attach() if isinstance(handle, SharedSnapshot) else handle
+
+    try:
+        tracks = snapshot.tracks()
+        beats, bpm, active_track = snapshot.beats, snapshot.bpm, snapshot.active_track
+        snapshot = None
+
+        if session.get("stream"):
+            # one variation, sent back bar by bar as it is sampled
+            candidate = None
+            for bar, candidate in generate_bars(
+                tracks, beats, active_track, bpm, backend.callbacks(callback), session.get("seed", -1), 
+                cache, callback.is_cancelled, session.get("bars"), session.get("selected_tracks"), backend
+            ):
+                results.put(("bar", request_id, (bar, candidate)))
+            return [candidate] if candidate is not None else []
+
+        return generate(
+            tracks, beats, active_track, bpm, session.get("batch_size", 1),
+            backend.callbacks(callback), session.get("seed", -1), cache, callback.is_cancelled,
+            session.get("bars"), session.get("selected_tracks"), backend
+        )
+
+    finally:
+        tracks = None
+        if isinstance(handle, SharedSnapshot):
+            try:
+                handle.detach()
+            except BufferError:
+                pass        # a traceback still holds a view, unmapped when it goes
+
+def generation_worker(requests, results, cancel_before, warm=True, backend="midigpt"):
+    """
+    Main loop of the generation server process. Warms the model up, then
+    serves requests until told to stop.
+
+    Requests are tuples ("generate", id, session), ("ping", id) or ("stop",),
+    where session is a dict with a snapshot (SessionSnapshot or SharedSnapshot)
+    and optionally batch_size, seed, timeout (seconds), bars (first, end),
+    selected_tracks and stream. Results are
+    ("ready", None, seconds), ("pong", id, cache stats), ("progress", id, dict),
+    ("stats", id, cache stats), ("bar", id, (bar, candidate)) for each bar of a
+    stream request,
+    ("done", id, candidates), ("cancelled", id, None) or ("error", id, message).
+    Requests with an id below cancel_before are abandoned. backend names
+    an entry of BACKENDS.
+    """
+    start_time = time.time()
+    cache = ResultCache()
+    backend = BACKENDS[backend]()
+
+    if warm:
+        try:
+            warm_up(backend)
+        except Exception as e:
+            print(f"Generation warm-up failed: {e}")
+
+    results.put(("ready", None, time.time() - start_time))
+
+    while True:
+        request = requests.get()
+        kind = request[0]
+
+        if kind == "stop":
+            break
+
+        if kind == "ping":
+            results.put(("pong", request[1], cache.stats()))
+            continue
+
+        if kind == "generate":
+            request_id, session = request[1], request[2]
+
+            deadline = None
+            if session.get("timeout"):
+                deadline = time.time() + session["timeout"]
+            callback = ProgressCallback(request_id, results, cancel_before, deadline)
+
+            try:
+                if callback.is_cancelled():
+                    raise GenerationCancelled()
+
+                callback.report(force=True)
+                candidates = run_request(request_id, session, results, callback, cache, backend)
+
+                if callback.is_cancelled():
+                    raise GenerationCancelled()
+
+                results.put(("stats", request_id, cache.stats()))
+                results.put(("done", request_id, candidates))
+
+            except Exception as e:
+                if callback.is_cancelled():
+                    results.put(("cancelled", request_id, None))
+                else:
+                    results.put(("error", request_id, str(e)))
+
+class GenerationServer:
+    """
+    Parent-side handle on a long-lived generation process.
+
+    The process keeps midigpt and libtorch loaded between requests (see
+    MidiGPTBackend for the checkpoint). poll()
+    must be called regularly (the GUI does it from a timer): it delivers
+    results to the callbacks, pings the worker while it is idle and restarts
+    it, resubmitting any unfinished request, if it dies or stops answering.
+
+    Cancelled or timed out requests are stopped through the sampling
+    callback; if the model does not stop within cancel_grace seconds the
+    worker is restarted so the next request is never stuck behind it. The
+    new worker pays the start-up and warm-up again.
+    """
+
+    def __init__(self, ping_interval=5.0, ping_timeout=10.0, max_restarts=3, cancel_grace=1.0, backend="midigpt"):
+        self.backend = backend          # name of the BACKENDS entry the worker runs
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.max_restarts = max_restarts
+        self.cancel_grace = cancel_grace
+
+        self.context = multiprocessing.get_context("spawn")    # never fork the GUI/audio process
+        self.process = None
+        self.requests = None
+        self.results = None
+
+        self.ready = False
+        self.restarts = 0
+        self.next_id = 0
+        self.pending = {}               # request id -> session, until a result arrives
+        self.shared = {}                # request id -> SharedSnapshot the worker may still read
+        self.running = {}               # request id -> time the worker started it
+        self.cancelling = {}            # request id -> time it was cancelled
+        self.cancel_before = self.context.Value('i', 0)
+        self.cache_stats = {}           # the worker's ResultCache counters, as last reported
+        self.ping_id = None
+        self.ping_time = None
+        self.last_seen = None
+
+        self.on_ready = None
+        self.on_result = None
+        self.on_error = None
+        self.on_progress = None
+        self.on_bar = None
+        self.on_cancelled = None
+
+    def start(self):
+        self.requests = self.context.Queue()
+        self.results = self.context.Queue()
+        self.process = self.context.Process(target=generation_worker, args=(self.requests, self.results, self.cancel_before, True, self.backend), daemon=True)
+        self.process.start()
+        self.ready = False
+        self.ping_id = None
+        self.last_seen = time.time()
+        print(f"Generation server started (pid {self.process.pid})")
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.requests.put(("stop",))
+            self.process.join(2)
+        self.killProcess()
+        self.ready = False
+        self.releaseShared()
+
+    def killProcess(self, timeout=2.0):
+        """
+        Terminate the worker, kill it if it does not exit within timeout
+        seconds, and drop it.
+        """
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.process = None
+
+    def restart(self):
+        print("Restarting generation server")
+        self.killProcess()
+        self.running.clear()
+        self.cancelling.clear()
+        for request_id in [request_id for request_id in self.shared if request_id not in self.pending]:
+            self.shared.pop(request_id).release()
+        self.start()
+
+        # the new worker serves the requests in order once it is ready
+        for request_id, session in self.pending.items():
+            self.requests.put(("generate", request_id, session))
+
+    def busy(self):
+        return len(self.pending) > 0
+
+    def cancel(self, request_id):
+        """
+        Cancel a request and every request submitted before it.
+        """
+        if request_id + 1 <= self.cancel_before.value:
+            return
+        self.cancel_before.value = request_id + 1
+
+        now = time.time()
+        for pending_id in list(self.pending):
+            if pending_id <= request_id:
+                self.pending.pop(pending_id)
+                self.cancelling[pending_id] = now
+                if self.on_cancelled:
+                    self.on_cancelled(pending_id)
+
+    def healthy(self):
+        return self.process is not None and self.process.is_alive()
+
+    def submit(self, session):
+        """
+        Queue a generation. A SessionSnapshot in the session is moved into
+        shared memory, so only its handle is pickled.
+        """
+        request_id = self.next_id
+        self.next_id += 1
+
+        snapshot = session.get("snapshot")
+        if isinstance(snapshot, SessionSnapshot):
+            session = dict(session, snapshot=snapshot.share())
+            self.shared[request_id] = session["snapshot"]
+
+        self.pending[request_id] = session
+        self.requests.put(("generate", request_id, session))
+        return request_id
+
+    def poll(self):
+        if self.process is None:
+            return
+
+        while True:
+            try:
+                kind, request_id, value = self.results.get_nowait()
+            except queue.Empty:
+                break
+
+            self.last_seen = time.time()
+
+            if kind == "ready":
+                self.ready = True
+                print(f"Generation server ready after {value:.2f} seconds")
+                if self.on_ready:
+                    self.on_ready(value)
+
+            elif kind == "stats":
+                self.cache_stats = value
+
+            elif kind == "pong":
+                self.cache_stats = value
+                if request_id == self.ping_id:
+                    self.ping_id = None
+                    self.restarts = 0
+
+            elif kind == "progress":
+                self.running.setdefault(request_id, time.time())
+                if self.on_progress and request_id in self.pending:
+                    self.on_progress(request_id, value)
+
+            elif kind == "bar":
+                self.running.setdefault(request_id, time.time())
+                if self.on_bar and request_id in self.pending:
+                    self.on_bar(request_id, *value)
+
+            elif kind == "done":
+                self.finished(request_id)
+                self.restarts = 0
+                if self.pending.pop(request_id, None) is not None and self.on_result:
+                    self.on_result(request_id, value)
+
+            elif kind == "cancelled":
+                self.finished(request_id)
+                self.restarts = 0
+
+            elif kind == "error":
+                self.finished(request_id)
+                if self.pending.pop(request_id, None) is not None:
+                    print(f"Generation {request_id} failed: {value}")
+                    if self.on_error:
+                        self.on_error(request_id, value)
+
+        self.checkHealth()
+
+    def finished(self, request_id):
+        self.running.pop(request_id, None)
+        self.cancelling.pop(request_id, None)
+        shared = self.shared.pop(request_id, None)
+        if shared is not None:
+            shared.release()
+
+    def releaseShared(self):
+        for shared in self.shared.values():
+            shared.release()
+        self.shared.clear()
+
+    def checkHealth(self):
+        now = time.time()
+
+        if not self.healthy():
+            self.crashed("Generation server exited")
+            return
+
+        # requests past their deadline are cancelled like any other
+        for request_id, started in list(self.running.items()):
+            session = self.pending.get(request_id)
+            if session is not None and session.get("timeout") and now - started > session["timeout"]:
+                print(f"Generation {request_id} timed out")
+                self.cancel(request_id)
+
+        # the model ignored the cancellation, free the worker the hard way
+        for request_id, cancelled in list(self.cancelling.items()):
+            if request_id in self.running and now - cancelled > self.cancel_grace:
+                print(f"Generation {request_id} did not stop when cancelled")
+                self.restart()
+                return
+
+        # a busy worker cannot answer pings, only check it while idle
+        if not self.ready or self.busy():
+            self.ping_id = None
+            return
+
+        if self.ping_id is not None:
+            if now - self.ping_time > self.ping_timeout:
+                self.crashed("Generation server stopped responding")
+            return
+
+        if now - self.last_seen > self.ping_interval:
+            self.ping_id = self.next_id
+            self.next_id += 1
+            self.ping_time = now
+            self.requests.put(("ping", self.ping_id))
+
+    def crashed(self, reason):
+        print(reason)
 
-    e.json_to_midi(midi_str, midi_dest)
+        if self.restarts >= self.max_restarts:
+            print("Generation server keeps failing, giving up")
+            for request_id in list(self.pending):
+                if self.on_error:
+                    self.on_error(request_id, reason)
+            self.pending.clear()
+            # a hung worker would keep its memory and the shared blocks mapped
+            self.killProcess()
+            self.releaseShared()
+            self.ready = False
+            return
 
-    queue.put("done")
-    
\ No newline at end of file
+        self.restarts += 1
+        self.restart()
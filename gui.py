@@ -1,7 +1,7 @@
 from PyQt6.QtWidgets import (
     QApplication, QWidget, 
     QVBoxLayout, QHBoxLayout, QGridLayout,  
-    QPushButton, QComboBox, QLabel, QSlider, QSpinBox,
+    QPushButton, QComboBox, QLabel, QSlider, QSpinBox, QCheckBox,
     QDialog, QDialogButtonBox, QFileDialog,
     QGraphicsView, QGraphicsScene, 
     QGraphicsRectItem, QGraphicsItem,QStackedLayout
@@ -9,19 +9,22 @@ from PyQt6.QtWidgets import (
 
 from PyQt6.QtGui import (
     QPainter, QColor, QIcon, QPen, QBrush, 
-    QPaintEvent, QResizeEvent
+    QPaintEvent, QResizeEvent, QFont, QKeySequence, QShortcut
 )
 
 from PyQt6.QtCore import (
-    Qt, QThread, QObject, QEvent,
+    Qt, QThread, QObject, QEvent, QTimer,
     pyqtSlot, pyqtSignal
 )
 
 from device_manager import MIDIListener
 from looper import Looper
 from timeline import Timeline
-from midi import ( Track, Note, ControlChange, quantise )
-from generate import generate_task
+from midi import ( Track, Note, ControlChange, quantise, QUANTISATIONS )
+from generate import GenerationServer, CandidateCache, session_key, splice_bars
+from session import SessionSnapshot
+from startup import profile
+import latency
 
 import mido
 import os
@@ -29,7 +32,6 @@ import sys
 import time
 import json
 from multiprocessing import Process, Queue
-import midigpt
 
 class TopBar(QHBoxLayout):
     def __init__(self, buttons):
@@ -50,6 +52,7 @@ class TrackControls(QWidget):
 
         # outline border
         self.soundfont_select = QComboBox()
+        self.presets = []           # (soundfont, bank, preset) of each dropdown entry
         self.select_button = QPushButton(f"Track {track_number}")
         self.mute_button = QPushButton(QIcon.fromTheme("audio-volume-muted"), "")
         self.solo_button = QPushButton(QIcon.fromTheme("audio-volume-high"), "")
@@ -87,11 +90,30 @@ class TrackControls(QWidget):
             return True
         return False
 
-    def soundFontListUpdated(self, soundfonts):
-        selected = self.soundfont_select.currentText()
+    def soundFontListUpdated(self, presets):
+        """
+        Fill the dropdown with (soundfont, bank, preset, preset name) entries
+        from the synth's index.
+        """
+        # refilling the list is not a selection, the synth keeps its font
+        selected = self.selectedPreset()
+        self.presets = [preset[:3] for preset in presets]
+        self.soundfont_select.blockSignals(True)
         self.soundfont_select.clear()
-        self.soundfont_select.addItems(soundfonts)
-        self.soundfont_select.setCurrentText(selected)
+        for name, bank, preset, preset_name in presets:
+            self.soundfont_select.addItem(f"{name}: {bank}:{preset} {preset_name}")
+        if selected in self.presets:
+            self.soundfont_select.setCurrentIndex(self.presets.index(selected))
+        self.soundfont_select.blockSignals(False)
+        
+    def selectedPreset(self):
+        """
+        (soundfont, bank, preset) picked in the dropdown, or None.
+        """
+        index = self.soundfont_select.currentIndex()
+        if index < 0 or index >= len(self.presets):
+            return None
+        return self.presets[index]
     
     def setSoundFont(self, soundfont):
         pass
@@ -109,14 +131,11 @@ class MIDIControls(QWidget):
         self.quantise_label = QLabel("Quantise:")
         self.quantise_select.addItem("Off", 0)
         
-        self.quantise_select.addItem("4/1", 0.25)
-        self.quantise_select.addItem("2/1", 0.5)
-        self.quantise_select.addItem("1/1", 1)
-        self.quantise_select.addItem("1/2", 2)
-        self.quantise_select.addItem("1/4", 4)
-        self.quantise_select.addItem("1/8", 8)
-        self.quantise_select.addItem("1/16", 16)
-        self.quantise_select.addItem("1/32", 32)
+        for quantisation in QUANTISATIONS:
+            if quantisation < 1:
+                self.quantise_select.addItem(f"{int(1 / quantisation)}/1", quantisation)
+            else:
+                self.quantise_select.addItem(f"1/{quantisation}", quantisation)
         for button in (self.delete_button, self.record_button, self.load_button, self.save_button, self.generate_button):
             button.setFixedSize(30, 30)
             
@@ -161,6 +180,103 @@ class AutomaticDeviceSwitchDialog(QDialog):
         layout.addWidget(button_box)
         self.setLayout(layout)
 
+class LatencyHistogram(QWidget):
+    
+    def __init__(self):
+        super().__init__()
+        self.counts = []
+        self.low = 0
+        self.high = 0
+        self.setMinimumSize(300, 120)
+        
+    def setHistogram(self, counts, edges):
+        self.counts = list(counts)
+        self.low = edges[0]
+        self.high = edges[-1]
+        self.update()
+        
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(30, 30, 30))
+        
+        if not self.counts or max(self.counts) == 0:
+            return
+        
+        label_height = 15
+        height = self.height() - label_height
+        width = self.width() / len(self.counts)
+        top = max(self.counts)
+        
+        painter.setBrush(QBrush(QColor(100, 180, 255)))
+        painter.setPen(Qt.PenStyle.NoPen)
+        for i, count in enumerate(self.counts):
+            bar = int(height * count / top)
+            painter.drawRect(int(i * width), height - bar, max(1, int(width) - 1), bar)
+        
+        painter.setPen(QColor(200, 200, 200))
+        painter.drawText(2, self.height() - 3, f"{self.low:.1f} ms")
+        painter.drawText(self.width() - 60, self.height() - 3, f"{self.high:.1f} ms")
+
+class LatencyPanel(QWidget):
+    """
+    Debug window over latency.monitor: the statistics of every measurement
+    and a histogram of one. Opening it turns the monitor on, closing it
+    turns it off again unless it was already on.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Latency")
+        
+        self.enabled = QCheckBox("Measure")
+        self.enabled.toggled.connect(lambda on: latency.monitor.enable() if on else latency.monitor.disable())
+        self.reset_button = QPushButton("Reset")
+        self.reset_button.clicked.connect(latency.monitor.reset)
+        self.measurement = QComboBox()
+        for name, description in latency.monitor.MEASUREMENTS.items():
+            self.measurement.addItem(description, name)
+        
+        self.stats = QLabel()
+        self.stats.setFont(QFont("monospace"))
+        self.histogram = LatencyHistogram()
+        
+        controls = QHBoxLayout()
+        controls.addWidget(self.enabled)
+        controls.addWidget(self.reset_button)
+        controls.addWidget(self.measurement, stretch=1)
+        
+        layout = QVBoxLayout()
+        layout.addLayout(controls)
+        layout.addWidget(self.stats)
+        layout.addWidget(self.histogram, stretch=1)
+        self.setLayout(layout)
+        
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.was_enabled = False
+        
+    def showEvent(self, event):
+        # left as it was on close if something else had turned it on
+        self.was_enabled = latency.monitor.enabled
+        self.enabled.setChecked(True)
+        self.timer.start(500)
+        self.refresh()
+        
+    def hideEvent(self, event):
+        self.timer.stop()
+        if not self.was_enabled:
+            self.enabled.setChecked(False)
+            latency.monitor.disable()
+        
+    def refresh(self):
+        lines = [f"{'':>9} {'count':>7} {'mean':>7} {'p50':>7} {'p99':>7} {'max':>7} {'jitter':>7}"]
+        for name, stat in latency.monitor.stats().items():
+            lines.append(f"{name:>9} {stat['count']:>7} {stat['mean']:>7.2f} {stat['p50']:>7.2f} "
+                         f"{stat['p99']:>7.2f} {stat['max']:>7.2f} {stat['jitter']:>7.2f}")
+        self.stats.setText("\n".join(lines))
+        
+        self.histogram.setHistogram(*latency.monitor.histogram(self.measurement.currentData(), bins=40))
+
 def is_empty_track(track):
     
     for msg in track:
@@ -180,10 +296,19 @@ def is_empty_track(track):
     return True
 
 class MainWindow(QWidget, MIDIListener):
+    
+    # emitted from the audio start-up thread, delivered on the GUI thread
+    synthReady = pyqtSignal()
+    metronomeReady = pyqtSignal()
+    
     def __init__(self, looper):
         super().__init__()
         
         self.looper = looper
+        self.synthReady.connect(self.synthInitialised)
+        self.metronomeReady.connect(self.metronomeInitialised)
+        looper.synth.on_ready = self.synthReady.emit
+        looper.metronome.on_ready = self.metronomeReady.emit
 
         self.setWindowTitle("AI Looper v1.0")
         self.setMinimumSize(800, 600)
@@ -229,6 +354,14 @@ class MainWindow(QWidget, MIDIListener):
         self.transpose.setValue(0)
         self.transpose.valueChanged.connect(lambda value: setattr(looper, "transpose", value))
         
+        # a fixed seed makes generations repeatable, so they can be served
+        # from the result cache on disk
+        self.seed = QSpinBox()
+        self.seed.setRange(-1, 2 ** 31 - 1)
+        self.seed.setValue(-1)
+        self.seed.setSpecialValueText("Random seed")
+        self.seed.setToolTip("Generation seed")
+        
         for button in (self.playpause_button, self.metronome_button, self.record_button, self.loop_button):
             button.setCheckable(True)
         
@@ -239,6 +372,7 @@ class MainWindow(QWidget, MIDIListener):
             self.record_button,
             self.device_chooser,
             self.transpose,
+            self.seed,
             self.import_button,
             self.export_button,
             self.generate_button 
@@ -271,9 +405,8 @@ class MainWindow(QWidget, MIDIListener):
             track_control.volume_slider.valueChanged.connect(
                 lambda value, i=index: self.looper.setVolume(i, value)
             )
-            track_control.soundfont_select.addItems(looper.synth.listLoadedSoundFonts())
             track_control.soundfont_select.currentIndexChanged.connect(
-                lambda _, i=index, t=track_control: self.looper.synth.assignSoundFont(i, t.soundfont_select.currentText())
+                lambda _, i=index, t=track_control: self.selectSoundFont(i, t.selectedPreset())
             )
 
         self.activeHighlight = QWidget(self)
@@ -336,41 +469,180 @@ class MainWindow(QWidget, MIDIListener):
         looper.on_track_change = self.looper_on_track_change
         looper.on_active_track_change = self.looper_on_active_track_change
         
-        self.gen_process = None
-        self.queue = None
         self.times = []
         
+        # the model stays loaded in a server process between generations
+        self.generator = GenerationServer()
+        self.generator.on_result = self.generate_complete
+        self.generator.on_error = self.generate_failed
+        self.generator.on_progress = self.generate_progress
+        self.generator.on_bar = self.generate_bar
+        self.generator.on_cancelled = self.generate_cancelled
+        self.generator.on_ready = lambda seconds: profile.mark("generation server ready")
+        self.timer = self.startTimer(50)
+        
+        # the model process is started once the window is up, or by the
+        # first generate if that comes sooner
+        self.generator_delay = 3000     # milliseconds after start-up
+        QTimer.singleShot(self.generator_delay, self.startGenerator)
+        
+        # each request samples a batch of variations, later clicks cycle through them
+        self.variations = 4
+        self.candidates = CandidateCache()
+        self.request_keys = {}          # request id -> session key
+        self.request_bars = {}          # request id -> bars it regenerates
+        self.seed_requests = {}         # session key -> seeded requests made for it
+        self.waiting_key = None         # session key a click is waiting on
+        self.streaming = set()          # request ids whose bars are spliced in as they arrive
+        # one sample call per bar hears the first bar sooner but finishes
+        # later; off until measured against the model (benchmark.py --suite streaming)
+        self.stream_bars = False
+        self.generate_timeout = 60      # seconds before a generation is abandoned
+        
+        # F12 opens the latency debug panel
+        self.latency_panel = LatencyPanel()
+        QShortcut(QKeySequence("F12"), self, activated=self.latency_panel.show)
+        
     def connectDeviceMonitor(self, monitor):
         self.device_chooser.currentIndexChanged.connect(lambda index: monitor.connect_to_device(self.device_chooser.currentText()))
     
+    def generateSelection(self):
+        """
+        Bars and tracks to regenerate: the bars selected on the timeline, or
+        the whole active track if nothing is selected.
+        """
+        if self.timeline.selection is None:
+            return None, [self.looper.active_track]
+        track_index, first_bar, end_bar = self.timeline.selection
+        return (first_bar, end_bar), [track_index]
+    
+    def startGenerator(self):
+        if self.generator.process is None:
+            profile.mark("generation server starting")
+            self.generator.start()
+    
+    @pyqtSlot()
+    def synthInitialised(self):
+        profile.mark("soundfonts loaded")
+        self.soundFontListUpdated(self.looper.synth.listPresets())
+        
+    @pyqtSlot()
+    def metronomeInitialised(self):
+        profile.mark("metronome ready")
+        if self.looper.synth.ready.is_set():
+            profile.report()
+    
     @pyqtSlot()
     def start_generate(self):
-        if self.gen_process is not None and self.gen_process.is_alive():
-            return
+        self.startGenerator()
+        looper = self.looper
+        bars, selected_tracks = self.generateSelection()
+        key = session_key(looper.tracks, looper.beats, looper.active_track, looper.bpm, bars, selected_tracks, self.seed.value())
+        self.start_time = time.time()
+        
+        candidate = self.candidates.next(key)
+        if candidate is not None:
+            print("Using cached variation")
+            self.installCandidate(candidate, bars)
+            self.waiting_key = None
+        else:
+            self.waiting_key = key
+            
+        # nothing to show yet: sample a batch, or stream one variation in
+        # bar by bar and top the cache up once it is done
+        if candidate is None:
+            self.requestVariations(key, bars, selected_tracks, stream=self.stream_bars)
+            
+        # top the cache up in the background while the loop plays
+        elif self.candidates.remaining(key) <= 1:
+            self.requestVariations(key, bars, selected_tracks)
+            
+    def installCandidate(self, candidate, bars=None):
+        # only the regenerated bars change, the rest of each track is kept as is
+        looper = self.looper
+        for track_index, track in candidate.items():
+            looper.setTrack(track_index, splice_bars(looper.tracks[track_index], track, bars, looper.beats))
+            
+    def requestVariations(self, key, bars=None, selected_tracks=None, stream=False):
+        if self.generator.busy():
+            if key in self.request_keys.values():
+                return
+            # the session changed, the running generation is stale
+            for request_id in list(self.request_keys):
+                self.generator.cancel(request_id)
 
         print("Starting generation")
-
-        self.queue = Queue()
-        self.gen_process = Process(target=generate_task, args=(self.queue, self.looper))
-        self.gen_process.start()
         
-        self.timer = self.startTimer(50)  # Check every 0.5s
-        self.start_time = time.time()
+        # only the notes and settings cross to the generation process
+        session = {
+            'snapshot': SessionSnapshot.from_looper(self.looper),
+            'batch_size': 1 if stream else self.variations,
+            'timeout': self.generate_timeout,
+            'bars': bars,
+            'selected_tracks': selected_tracks,
+            'stream': stream,
+            'seed': self.requestSeed(key)
+        }
+        request_id = self.generator.submit(session)
+        self.request_keys[request_id] = key
+        self.request_bars[request_id] = bars
+        if stream:
+            self.streaming.add(request_id)
 
+    def requestSeed(self, key):
+        """
+        The seed of the next request for key: random, or the chosen seed
+        plus the number of requests already made for key, so topping up
+        brings new variations and the same sequence repeats from the cache.
+        """
+        seed = self.seed.value()
+        if seed < 0:
+            return -1
+        count = self.seed_requests.get(key, 0)
+        self.seed_requests[key] = count + 1
+        return seed + count
+    
     def timerEvent(self, event):
         #print("Timer event")
-        if self.queue and not self.queue.empty():
-            result = self.queue.get()
-            if result == "done":
-                self.generate_complete()
-                #self.looper_worker.on_generate_complete()
-                self.killTimer(self.timer)
+        self.generator.poll()
 
-    def generate_complete(self):
+    def generate_progress(self, request_id, progress):
+        self.generate_button.setText(f"Generating... {progress['bars']} bars, {progress['elapsed']:.1f}s")
+    
+    def generate_cancelled(self, request_id):
+        self.request_keys.pop(request_id, None)
+        self.request_bars.pop(request_id, None)
+        self.streaming.discard(request_id)
+        # a superseding request keeps reporting its own progress
+        if not self.request_keys:
+            self.generate_button.setText("Generate")
+        
+    def generate_bar(self, request_id, bar, candidate):
+        if request_id not in self.streaming or self.request_keys.get(request_id) != self.waiting_key:
+            return
+        print(f"Bar {bar} generated after {time.time() - self.start_time:.2f} seconds")
+        looper = self.looper
+        for track_index, track in candidate.items():
+            # onto the track as it will be after the bars already queued
+            base = looper.pendingTrack(track_index)
+            looper.queueTrack(track_index, splice_bars(base, track, (bar, bar + 1), looper.beats))
+    
+    def generate_failed(self, request_id, message):
+        print(f"Generation failed: {message}")
+        self.request_keys.pop(request_id, None)
+        self.request_bars.pop(request_id, None)
+        self.streaming.discard(request_id)
+        self.generate_button.setText("Generate")
+    
+    def generate_complete(self, request_id, candidates):
         print("Generate complete!!")
-        midi_path = "midi/output.mid"
-        midi_file = mido.MidiFile(midi_path)
-        self.looper.loadTrack(midi_file, self.looper.active_track)
+        self.generate_button.setText("Generate")
+        key = self.request_keys.pop(request_id, None)
+        bars = self.request_bars.pop(request_id, None)
+        self.candidates.add(key, candidates)
+        streamed = request_id in self.streaming
+        self.streaming.discard(request_id)
+        
         elapsed_time = time.time() - self.start_time
         self.times.append(elapsed_time)
         print(f"Generation took {elapsed_time:.2f} seconds")
@@ -379,10 +651,34 @@ class MainWindow(QWidget, MIDIListener):
             print(t)
             
         print(f"Average time: {sum(self.times) / len(self.times):.2f} seconds")
+        
+        if key is not None and key == self.waiting_key:
+            self.waiting_key = None
+            candidate = self.candidates.next(key)
+            # a streamed variation is already queued bar by bar
+            if not streamed:
+                self.installCandidate(candidate, bars)
+            
+        # more variations of the same session, unless it changed meanwhile
+        if streamed and key is not None and self.candidates.remaining(key) <= 1:
+            looper = self.looper
+            bars, selected_tracks = self.generateSelection()
+            if key == session_key(looper.tracks, looper.beats, looper.active_track, looper.bpm, bars, selected_tracks, self.seed.value()):
+                self.requestVariations(key, bars, selected_tracks)
     
-    def soundFontListUpdated(self, soundfonts):
+    def closeEvent(self, event):
+        self.generator.stop()
+        super().closeEvent(event)
+    
+    def soundFontListUpdated(self, presets):
         for track_control in self.track_controls:
-            track_control.soundFontListUpdated(soundfonts)
+            track_control.soundFontListUpdated(presets)
+            
+    def selectSoundFont(self, track_number, selection):
+        if selection is None:
+            return
+        name, bank, preset = selection
+        self.looper.requestSoundFont(track_number, name, bank, preset)
     
     def openFileDialog(self, track_number):
         default_dir = os.path.join(os.path.dirname(__file__), "midi")
@@ -410,7 +706,7 @@ class MainWindow(QWidget, MIDIListener):
             midi.tracks.append(track.midi_track)
             quantisation = self.looper.quantise[track_number]
             if quantisation != 0:            
-                midi = quantise(midi, quantisation)
+                midi = quantise(midi, quantisation, self.looper.quantise_strength[track_number], self.looper.quantise_swing[track_number])
             midi.save(filename)
                 
     def importSongDialog(self):
@@ -480,7 +776,6 @@ class MainWindow(QWidget, MIDIListener):
     def selectQuantisation(self, track_number, quantisation):
         
         self.looper.setQuantise(track_number, quantisation)
-        self.timeline.tracks[track_number].quantisation = quantisation
         #self.timeline.setTrack(self.looper.tracks[track_number], track_number)
         self.timeline.viewport().update()
     
@@ -501,6 +796,7 @@ class MainWindow(QWidget, MIDIListener):
             self.device_chooser.addItem("No MIDI Device")
         
         
-    def midiEvent(self, msg):
-        self.looper.handleMidiEvent(msg)
+    def midiEvent(self, msg, received=None):
+        # called on the MIDI thread, the engine picks it up on its next cycle
+        self.looper.receiveMidi(msg, received)
     
\ No newline at end of file
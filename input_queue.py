@@ -0,0 +1,73 @@
+import threading
+
+class InputQueue:
+    """
+    Bounded single-producer, single-consumer queue of (received, msg)
+    pairs, received being the time.perf_counter() the MIDI thread got msg.
+
+    The producer only writes slots and advances tail, the consumer only
+    reads them and advances head, so neither takes a lock: a slot is
+    filled before tail moves past it, and each counter has one writer.
+    A full queue drops the new event and counts it rather than block the
+    MIDI thread.
+
+    A consumer that polls often enough needs nothing else. One that goes
+    idle for longer calls sleep(), which raises waiting, and only then does
+    push set ready, taking the Event's lock, to wake it early.
+    """
+
+    def __init__(self, size=1024):
+        self.slots = [None] * size
+        self.head = 0           # next slot to read, written by the consumer
+        self.tail = 0           # next slot to write, written by the producer
+        self.dropped = 0
+        self.waiting = False    # written by the consumer while it sleeps
+        self.ready = threading.Event()
+
+    def push(self, item):
+        tail = self.tail
+        if tail - self.head >= len(self.slots):
+            self.dropped += 1
+            return False
+        self.slots[tail % len(self.slots)] = item
+        self.tail = tail + 1
+        if self.waiting:
+            self.ready.set()
+        return True
+
+    def drain(self, limit=None):
+        """
+        Take every event queued so far, oldest first, up to limit.
+        """
+        head = self.head
+        tail = self.tail
+        if limit is not None:
+            tail = min(tail, head + limit)
+
+        size = len(self.slots)
+        items = []
+        for position in range(head, tail):
+            index = position % size
+            items.append(self.slots[index])
+            self.slots[index] = None
+        self.head = tail
+        return items
+
+    def sleep(self, timeout):
+        """
+        Consumer side: wait up to timeout for a push, returning at once if
+        anything is queued already. True if woken by a push.
+        """
+        self.waiting = True
+        # cleared after waiting is raised, so a push either sees waiting
+        # or has moved tail before the check below
+        self.ready.clear()
+        if self.tail != self.head:
+            self.waiting = False
+            return True
+        woken = self.ready.wait(timeout)
+        self.waiting = False
+        return woken
+
+    def __len__(self):
+        return self.tail - self.head
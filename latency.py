@@ -0,0 +1,119 @@
+import time
+
+import numpy as np
+
+class RingHistogram:
+    """
+    The last size samples of one measurement, in milliseconds, in a
+    preallocated ring. Only one thread ever records into a ring, so a
+    sample costs one array store and no lock; readers copy the ring and
+    at worst miss the sample being written.
+    """
+
+    def __init__(self, size=4096):
+        self.values = np.zeros(size, dtype=np.float64)
+        self.written = 0
+
+    def record(self, value):
+        self.values[self.written % len(self.values)] = value
+        self.written += 1
+
+    def samples(self):
+        written = self.written
+        if written < len(self.values):
+            return self.values[:written].copy()
+        return self.values.copy()
+
+    def clear(self):
+        self.written = 0
+
+class LatencyMonitor:
+    """
+    Latency of live input and jitter of playback, off unless enabled.
+
+    Input is timestamped with time.perf_counter() where the MIDI thread
+    receives it, where Looper.handleMidiEvent picks it up and once
+    synth.noteon has returned.
+
+    Playback is only measured where this process plays it. Events the
+    looper or the transport's own queue play record how late they reached
+    the synth. Events handed to the fluidsynth sequencer play inside
+    fluidsynth, so for those the transport records the time to spare when
+    each was scheduled and how late its own cycles start instead. Every
+    call site checks enabled first, so a disabled monitor costs one
+    attribute read.
+    """
+
+    # measurement -> description, in the order they are reported
+    MEASUREMENTS = {
+        'dispatch': "MIDI thread to handleMidiEvent",
+        'input': "MIDI thread to synth.noteon",
+        'playback': "event played late, without the sequencer",
+        'slack': "time to spare scheduling on the sequencer (negative: late)",
+        'cycle': "transport cycle started late",
+    }
+
+    def __init__(self, size=4096):
+        self.enabled = False
+        self.rings = {name: RingHistogram(size) for name in self.MEASUREMENTS}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        for ring in self.rings.values():
+            ring.clear()
+
+    def now(self):
+        return time.perf_counter()
+
+    def record(self, name, seconds):
+        self.rings[name].record(seconds * 1000)
+
+    def since(self, name, stamp):
+        # stamp is a now() from earlier, None when it was taken while disabled
+        if stamp is not None:
+            self.rings[name].record((time.perf_counter() - stamp) * 1000)
+
+    def stats(self):
+        """
+        name -> dict of count, mean, p50, p99, max and jitter (standard
+        deviation), all in milliseconds, for every measurement with samples.
+        """
+        stats = {}
+        for name, ring in self.rings.items():
+            samples = ring.samples()
+            if len(samples) == 0:
+                continue
+            stats[name] = {
+                'count': ring.written,
+                'mean': float(samples.mean()),
+                'p50': float(np.percentile(samples, 50)),
+                'p99': float(np.percentile(samples, 99)),
+                'max': float(samples.max()),
+                'jitter': float(samples.std()),
+            }
+        return stats
+
+    def histogram(self, name, bins=20, limit=None):
+        """
+        (counts, edges) of a measurement's samples, edges in milliseconds
+        from 0 (or the smallest sample if negative) to limit (the largest
+        sample by default).
+        """
+        samples = self.rings[name].samples()
+        bottom = min(0.0, samples.min()) if len(samples) else 0.0
+        top = limit if limit is not None else (samples.max() if len(samples) else 1.0)
+        return np.histogram(samples, bins=bins, range=(bottom, max(top, bottom + 1e-3)))
+
+    def report(self):
+        print("Latency (ms)")
+        print(f"{'measurement':>12} {'count':>7} {'mean':>7} {'p50':>7} {'p99':>7} {'max':>7} {'jitter':>7}")
+        for name, stat in self.stats().items():
+            print(f"{name:>12} {stat['count']:>7} {stat['mean']:>7.2f} {stat['p50']:>7.2f} "
+                  f"{stat['p99']:>7.2f} {stat['max']:>7.2f} {stat['jitter']:>7.2f}")
+
+monitor = LatencyMonitor()
@@ -1,23 +1,26 @@
 import os, sys, random, time, json, threading
 
 import mido
-import fluidsynth
 
-sys.path.append("midigpt_workspace/MIDI-GPT/python_lib")
-import midigpt
 from multiprocessing import Process, Queue
 
 from PyQt6.QtCore import QObject, pyqtSignal, pyqtSlot, QThread
 #sys.path.append(os.path.dirname(os.getcwd()) + "/python_lib")
 
-from midi import ( Track, Note, ControlChange, is_empty_track, append_to_file )
-from synth import DefaultSynth
-from metronome import Metronome
+from midi import ( Track, Note, ControlChange, PLAYBACK_TYPES, is_empty_track )
+import latency
+from input_queue import InputQueue
 
 class Looper:
     
-    def __init__(self, bpm, beats, track_count):
-        
+    def __init__(self, bpm, beats, track_count, synth=None, metronome=None, clock=time.time):
+        """
+        synth, metronome and clock default to the fluidsynth synth, the
+        PyAudio metronome and time.time; benchmarks pass stand-ins so no
+        audio device is needed.
+        """
+        
+        self.clock = clock
         self.bpm = bpm
         self.beats = beats
         self.loops = 0
@@ -25,20 +28,35 @@ class Looper:
         self.playhead_position_beats = 0    # just used for emitting beat events
         self.elapsed_beats = 0
         self.last_time = None
+        self.notified_loops = 0
+        self.clock_lock = threading.Lock()
+        self.transport = None               # set when a Transport thread drives playback
         
         self.playing = False
         self.metronome_active = False
-        self.metronome = Metronome("audio/Metronomes/Perc_MetronomeQuartz_lo.wav", "audio/Metronomes/Perc_MetronomeQuartz_hi.wav")
+        if metronome is None:
+            from metronome import Metronome
+            metronome = Metronome("audio/Metronomes/Perc_MetronomeQuartz_lo.wav", "audio/Metronomes/Perc_MetronomeQuartz_hi.wav", background=True)
+        self.metronome = metronome
         self.recording = False
         
         self.transpose = 0
         self.tracks = [None] * track_count
+        self.queued_tracks = {}             # track number -> track to swap in at the next loop
+        self.changed_tracks = [False] * track_count     # changed off the GUI thread, not yet shown
+        self.input_queue = InputQueue()     # (received, msg) from the MIDI thread
         
         self.mutes = [False] * track_count
         self.solos = [False] * track_count
         self.volumes = [127] * track_count
         self.quantise = [0] * track_count
-        self.synth = DefaultSynth()
+        self.quantise_strength = [1.0] * track_count
+        self.quantise_swing = [0.0] * track_count
+        if synth is None:
+            from synth import DefaultSynth
+            synth = DefaultSynth(background=True)
+        self.synth = synth
+        self.synth.on_switch_ready = self.switchReady
         self.active_track = -1
         
         self.on_active_track_change = None
@@ -55,10 +73,25 @@ class Looper:
         self.piece = None
         self.status = None
     
+    def initialiseAudio(self):
+        """
+        Open the audio devices and load the soundfonts on a background thread
+        so the window can show first. synth.ready and metronome.ready are set
+        as each finishes.
+        """
+        def run():
+            self.synth.initialise()
+            self.metronome.initialise()
+            
+        thread = threading.Thread(target=run, name="audio-init", daemon=True)
+        thread.start()
+        return thread
+    
     def start(self):
         #self.last_beats = (time.time() / 60 * self.bpm) % self.beats
-        self.last_time = time.time()
-        self.playing = True
+        with self.clock_lock:
+            self.last_time = self.clock()
+            self.playing = True
         
     def pause(self):
         self.playing = False
@@ -102,10 +135,29 @@ class Looper:
             track = self.tracks[track_number] if track_number >= 0 else None
             self.on_active_track_change(track, track_number)
       
+    def requestSoundFont(self, track_number, name, bank=None, preset=None, boundary="beat"):
+        """
+        Change a track's soundfont at the next beat (or loop) once the
+        soundfont has loaded in the background, or as soon as it has loaded
+        if the looper is stopped.
+        """
+        self.synth.requestSoundFont(track_number, name, bank, preset, boundary)
+        
+    def switchReady(self, track_number):
+        # called from the loader thread, nobody is playing boundaries when stopped
+        if not self.is_playing():
+            for switch in self.synth.takeSwitches(loop_boundary=True):
+                self.synth.applySwitch(switch)
+                
+    def takeSwitches(self, loop_boundary=False):
+        if not hasattr(self.synth, "takeSwitches"):
+            return []
+        return self.synth.takeSwitches(loop_boundary)
+    
     def setSynth(self, track_number, sfid):
         self.synth.program_select(track_number, sfid, 0, 0)
         
-    def setQuantise(self, track_number, fraction):
+    def setQuantise(self, track_number, fraction, strength=1.0, swing=0.0):
         if track_number < 0:
             return
         if track_number >= len(self.tracks):
@@ -113,6 +165,18 @@ class Looper:
         
         print(f"Setting quantise for track {track_number} to {fraction}")
         self.quantise[track_number] = fraction
+        self.quantise_strength[track_number] = strength
+        self.quantise_swing[track_number] = swing
+        self.applyQuantise(track_number)
+        
+    def applyQuantise(self, track_number):
+        # the timeline draws tracks with their own quantisation settings
+        track = self.tracks[track_number]
+        if track is None:
+            return
+        track.quantisation = self.quantise[track_number]
+        track.strength = self.quantise_strength[track_number]
+        track.swing = self.quantise_swing[track_number]
         
     def updateVolumes(self):
         solo_count = sum(self.solos)
@@ -138,6 +202,7 @@ class Looper:
     
     def addEmptyTrack(self, track_number):
         self.tracks[track_number] = Track(None)
+        self.applyQuantise(track_number)
         self.on_track_change(self.tracks[track_number], track_number)
         return self.tracks[track_number]
     
@@ -160,6 +225,7 @@ class Looper:
             else:
                 self.tracks[index] = Track(track, ticks_per_beat)
 
+            self.applyQuantise(index)
             self.on_track_change(self.tracks[index], index)
             index += 1
             
@@ -188,6 +254,7 @@ class Looper:
                 else:
                     self.tracks[index] = Track(track, ticks_per_beat)
 
+                self.applyQuantise(index)
                 self.on_track_change(self.tracks[index], index)
                 print(f"Loaded track {track.name} \n")
             
@@ -196,10 +263,54 @@ class Looper:
             if index >= len(self.tracks):
                 break
     
+    def setTrack(self, track_number, track):
+        if track_number < 0 or track_number >= len(self.tracks):
+            return
+        self.tracks[track_number] = track
+        self.applyQuantise(track_number)
+        self.on_track_change(track, track_number)
+    
+    def queueTrack(self, track_number, track):
+        """
+        Replace a track at the start of the next loop, so material arriving
+        while the loop plays never cuts in mid-loop. Stopped loopers swap it
+        in straight away.
+        """
+        if track_number < 0 or track_number >= len(self.tracks):
+            return
+        if not self.is_playing():
+            self.setTrack(track_number, track)
+            return
+        with self.clock_lock:
+            self.queued_tracks[track_number] = track
+            
+    def pendingTrack(self, track_number):
+        """
+        The track as it will play from the next loop: the queued one if
+        there is one, the current one otherwise.
+        """
+        with self.clock_lock:
+            return self.queued_tracks.get(track_number, self.tracks[track_number])
+            
+    def spliceQueued(self):
+        """
+        Swap in the queued tracks, called by whoever plays the events right
+        at the loop boundary. The GUI hears about them in notifyPlayhead.
+        """
+        if not self.queued_tracks:
+            return
+        with self.clock_lock:
+            queued, self.queued_tracks = self.queued_tracks, {}
+        for track_number, track in queued.items():
+            self.tracks[track_number] = track
+            self.applyQuantise(track_number)
+            self.changed_tracks[track_number] = True
+    
     def load(self, midi, track_number):
         track = midi.tracks[0]
         ticks_per_beat = midi.ticks_per_beat
         self.tracks[track_number] = Track(track, ticks_per_beat)
+        self.applyQuantise(track_number)
         self.on_track_change(self.tracks[track_number], track_number)
     
     def export(self, filename):
@@ -219,22 +330,45 @@ class Looper:
                 #midi_track.append(mido.Message("note_off", note=60, velocity=0, time=1))
 
             else:
-                # convert the track to 480 ticks per beat
+                # the playback index in 480 ticks per beat, clipped to the loop,
+                # with the track's other messages (program changes, tempo and
+                # other meta) at their own times, ahead of events on the same tick
                 print(f"Exporting track {i}")
                 
-                for msg in track.midi_track:
-                    
-                    
-                    beats = msg.time / track.ticks_per_beat
-                    if beats > self.beats:
-                        print(f"Breaking at {beats} beats")
+                loop_ticks = int(round(self.beats * midi_file.ticks_per_beat))
+                placed = []
+                
+                for ticks, msg in zip(track.abs_ticks, track.midi_track):
+                    beats = ticks / track.ticks_per_beat
+                    if beats >= self.beats:
+                        break
+                    if msg.type in PLAYBACK_TYPES or msg.type in ("end_of_track", "track_name"):
+                        continue
+                    placed.append((int(round(beats * midi_file.ticks_per_beat)), 0, msg))
+                
+                for beats, msg in zip(track.event_beats, track.events):
+                    if beats >= self.beats:
                         break
+                    placed.append((int(round(beats * midi_file.ticks_per_beat)), 1, msg))
+                
+                placed.sort(key=lambda item: item[:2])
+                held = {}
+                prev_ticks = 0
+                
+                for ticks, _, msg in placed:
+                    key = (msg.channel, msg.note) if msg.type in ("note_on", "note_off") else None
+                    if key is not None:
+                        held[key] = held.get(key, 0) + (1 if msg.type == "note_on" and msg.velocity > 0 else -1)
                     
-                    ticks = int(beats * midi_file.ticks_per_beat)
-                    midi_track.append(msg.copy(time=ticks))
+                    midi_track.append(msg.copy(time=ticks - prev_ticks))
+                    prev_ticks = ticks
+                
+                # notes still held at the loop end stop there
+                for (channel, note), count in held.items():
+                    for _ in range(count):
+                        midi_track.append(mido.Message("note_off", channel=channel, note=note, velocity=0, time=loop_ticks - prev_ticks))
+                        prev_ticks = loop_ticks
             
-                # add a dummy note to the track
-
             midi_file.tracks.append(midi_track)
             
         print("Exported MIDI file:")
@@ -247,6 +381,9 @@ class Looper:
         midi_input = "midi/input.mid"
         self.export(midi_input)
 
+        sys.path.append("midigpt_workspace/MIDI-GPT/python_lib")
+        import midigpt
+        
         e = midigpt.ExpressiveEncoder()
         m2j = None
         try:
@@ -390,16 +527,18 @@ class Looper:
     
     def reset_playhead_button_pressed(self, event=None):
         
-        current_beats = ((time.time() / 60) * self.bpm) % self.beats
+        current_beats = ((self.clock() / 60) * self.bpm) % self.beats
         
         self.playhead_position_beats = 0
         
-        #self.last_beats = current_beats % self.beats
-        self.last_time = time.time()
-        self.elapsed_beats = 0
+        with self.clock_lock:
+            #self.last_beats = current_beats % self.beats
+            self.last_time = self.clock()
+            self.elapsed_beats = 0
+            self.loops = 0
+            self.notified_loops = 0
         
         self.on_playhead_position_change(0)
-        self.loops = 0
         
         for i in range(len(self.tracks)):
             self.synth.all_notes_off(i)
@@ -444,103 +583,184 @@ class Looper:
             #self.loadMIDI(midi_file)
             self.loadTrack(midi_file, self.active_track)
 
-        current_time = time.time()
+        # with a transport running, the clock, the events and the input
+        # belong to its thread and the GUI timer only draws the playhead
+        if self.transport is not None and self.transport.is_running():
+            self.notifyPlayhead()
+            return
+
+        now = self.clock()
+        delta_beats = self.advance(now)
+        
+        if self.transport is None or not self.transport.drainsInput():
+            self.drainInput()
         
         if not self.is_playing():
-            self.last_time = current_time
+            return
         
-        else:
+        beat_changed = int(self.playhead_position()) != int(self.playhead_position_beats)
+        
+        if self.metronome_active and beat_changed:
+            self.playMetronome(int(self.playhead_position()))
+            
+        if beat_changed:
+            for switch in self.takeSwitches(self.loops != self.notified_loops):
+                self.synth.applySwitch(switch)
+            
+        self.notifyPlayhead()
         
+        self.playEvents(self.elapsed_beats - delta_beats, self.elapsed_beats, now)
+        
+    def advance(self, current_time):
+        """
+        Move the playhead forward to current_time, wrapping at the loop length.
+        Returns the number of beats advanced.
+        """
+        with self.clock_lock:
+            
+            if not self.is_playing():
+                self.last_time = current_time
+                return 0
+            
             delta = current_time - self.last_time
             delta_beats = delta / 60 * self.bpm
             self.elapsed_beats += delta_beats
             self.last_time = current_time
             
-            looped = self.elapsed_beats >= self.beats
-            self.elapsed_beats %= self.beats
-
-            if self.on_playhead_position_change:
-                self.on_playhead_position_change(self.playhead_position())
-                
-            if self.on_beat and int(self.playhead_position()) != int(self.playhead_position_beats):
-                self.on_beat(self.playhead_position())
-                if self.metronome_active:
-                    if int(self.playhead_position()) % 4 == 0:
-                        self.metronome.clock()
-                    else:
-                        self.metronome.click()
-                    
-            self.playhead_position_beats = self.playhead_position()
-            
-            if self.on_loop and looped:
-                self.on_loop(self.loops)
+            if self.elapsed_beats >= self.beats:
+                self.elapsed_beats %= self.beats
                 self.loops += 1
-
-            for track_index in range(len(self.tracks)):
-                
-                if self.tracks[track_index] is None:
-                    continue
-                
-                track = self.tracks[track_index].midi_track
-                ticks_per_beat = self.tracks[track_index].ticks_per_beat
-                
-                if self.synth is None:
-                    continue
                 
-                if self.mutes[track_index]:
-                    continue
-                
-                if not self.solos[track_index] and any(self.solos):
-                    continue
+            return delta_beats
+        
+    def notifyPlayhead(self):
+        
+        if self.on_playhead_position_change:
+            self.on_playhead_position_change(self.playhead_position())
             
-                update_start = self.elapsed_beats - delta_beats
-                update_end = self.elapsed_beats
-                
-                acc_ticks = 0
+        if self.on_beat and int(self.playhead_position()) != int(self.playhead_position_beats):
+            self.on_beat(self.playhead_position())
+            
+        self.playhead_position_beats = self.playhead_position()
+        
+        # one notification per changed track, however many edits it had;
+        # the flag is cleared before the track is read so no edit is missed
+        for track_number, changed in enumerate(self.changed_tracks):
+            if changed:
+                self.changed_tracks[track_number] = False
+                if self.on_track_change:
+                    self.on_track_change(self.tracks[track_number], track_number)
+        
+        if self.loops != self.notified_loops:
+            self.notified_loops = self.loops
+            if self.on_loop and self.loops > 0:
+                self.on_loop(self.loops - 1)
+    
+    def playMetronome(self, beat, at=None):
+        # at is the time.time() the click should be heard, None for now
+        if beat % 4 == 0:
+            self.metronome.clock(at)
+        else:
+            self.metronome.click(at)
+    
+    def isAudible(self, track_index):
+        
+        if self.tracks[track_index] is None:
+            return False
+        
+        if self.mutes[track_index]:
+            return False
+        
+        if not self.solos[track_index] and any(self.solos):
+            return False
+        
+        return True
+        
+    def playEvents(self, update_start, update_end, end_time=None):
+        """
+        Send every event in [update_start, update_end) beats to the synth.
+        A window that starts before 0 straddles the loop boundary and is split
+        so the events at the end of the loop are not dropped.
+        
+        end_time is the clock time update_end was reached, used to measure
+        how late each event plays when the latency monitor is on.
+        """
+        if self.synth is None:
+            return
+        
+        if update_start < 0:
+            wrap_time = None if end_time is None else end_time - update_end * 60 / self.bpm
+            self.playEvents(update_start + self.beats, self.beats, wrap_time)
+            self.spliceQueued()
+            update_start = 0
+        
+        timed = end_time is not None and latency.monitor.enabled
+        
+        for track_index in range(len(self.tracks)):
+            
+            if not self.isAudible(track_index):
+                continue
+            
+            track = self.tracks[track_index]
+            
+            if not timed:
+                # only the events due in this window, found by binary search
+                for msg in track.events_between(update_start, update_end):
+                    self.playMessage(track_index, msg)
+                continue
+            
+            lo, hi = track.event_range(update_start, update_end)
+            for i in range(lo, hi):
+                self.playMessage(track_index, track.events[i])
+                due = end_time - (update_end - track.event_beats[i]) * 60 / self.bpm
+                latency.monitor.record('playback', self.clock() - due)
                 
-                for msg in track:
-                    
-                    acc_ticks += msg.time
-                    abs_beats = (acc_ticks / ticks_per_beat)# % self.beats
-
-                    # quantisation = self.quantise[track_index]
-                    #if quantisation != 0:
-                    #    abs_beats = round(abs_beats * quantisation) / quantisation
-                    # round the abs_beats to the nearest fraction of a beat
-                    # e.g. if the fraction is 4, and the abs_beats is 3.24, it will be rounded to 3.25
-                    
-                    
-                    #print(f"Abs beats: {abs_beats}, last beats: {self.last_beats}, current beats: {current_beats}, playhead: {self.playhead_position()}")
-                    
-                    # if the absolute time in beats is between the last time and the current time, play the note
-                    if abs_beats >= update_start and abs_beats < update_end:
-                        
-                        if msg.type == "note_on":
-                            self.synth.noteon(track_index, msg.note, msg.velocity)
-                            
-                        elif msg.type == "note_off":
-                            self.synth.noteoff(track_index, msg.note)
-                            
-                        elif msg.type == "pitchwheel":
-                            self.synth.pitch_bend(track_index, msg.pitch)
-                            
-                        elif msg.type == "control_change":
-                            self.synth.cc(track_index, msg.control, msg.value)
-                            
-                    if abs_beats > update_end:
-                        break
+    def playMessage(self, channel, msg):
+        
+        if msg.type == "note_on":
+            self.synth.noteon(channel, msg.note, msg.velocity)
+            
+        elif msg.type == "note_off":
+            self.synth.noteoff(channel, msg.note)
+            
+        elif msg.type == "pitchwheel":
+            self.synth.pitch_bend(channel, msg.pitch)
+            
+        elif msg.type == "control_change":
+            self.synth.cc(channel, msg.control, msg.value)
   
-    def handleMidiEvent(self, msg):
+    def receiveMidi(self, msg, received=None):
+        """
+        Queue a message from the MIDI thread for the engine; the only Looper
+        method that thread calls. received is the time.perf_counter() it
+        arrived.
+        """
+        if received is None:
+            received = time.perf_counter()
+        if not self.input_queue.push((received, msg)):
+            print(f"Input queue full, dropped {msg}")
+    
+    def drainInput(self):
+        """
+        Handle every queued input message, oldest first. Called once per
+        cycle by whichever thread runs the engine: the transport thread, or
+        update() without one.
+        """
+        for received, msg in self.input_queue.drain():
+            self.handleMidiEvent(msg, received)
+    
+    def handleMidiEvent(self, msg, received=None):
+        # received: time.perf_counter() when the MIDI thread got msg
+        if received is not None and latency.monitor.enabled:
+            latency.monitor.since('dispatch', received)
         
         if msg.type == "note_on" or msg.type == "note_off":
             msg.note += self.transpose
         
-        print(msg)
-
-        self.inputMonitoring(msg)
-        self.inputRecording(msg)
+        self.inputMonitoring(msg, received)
+        self.inputRecording(msg, received)
         
-    def inputRecording(self, msg):
+    def inputRecording(self, msg, received=None):
 
         if self.active_track < 0:
             return
@@ -558,20 +778,26 @@ class Looper:
         if msg.type == "note_on" or msg.type == "note_off":
             
             if active_track is None:
-                active_track = self.addEmptyTrack(self.active_track)
+                active_track = Track(None)
+                self.tracks[self.active_track] = active_track
+                self.applyQuantise(self.active_track)
             
-            midi_track = active_track.midi_track
             ticks_per_beat = active_track.ticks_per_beat
             
-            ticks = int((self.elapsed_beats * ticks_per_beat) % (self.beats * ticks_per_beat))
+            # place the note when it was played, not when it was taken off the queue
+            position = self.elapsed_beats
+            if received is not None:
+                position -= (time.perf_counter() - received) / 60 * self.bpm
             
-            midi = append_to_file(midi_track, msg, ticks)
+            ticks = int((position * ticks_per_beat) % (self.beats * ticks_per_beat))
             
-            self.tracks[self.active_track] = Track(midi_track)
+            # insert in place, the track keeps its notes and playback index current
+            active_track.record(msg, ticks)
             
-            self.on_track_change(self.tracks[self.active_track], self.active_track)
+            # the GUI redraws it once on its next frame
+            self.changed_tracks[self.active_track] = True
         
-    def inputMonitoring(self, msg):
+    def inputMonitoring(self, msg, received=None):
         # Input monitoring when the key is pressed
         if self.synth is None:
             return
@@ -585,7 +811,8 @@ class Looper:
         
         if msg.type == "note_on":
             self.synth.noteon(self.active_track, msg.note, msg.velocity)
-            print(f"Note on: {msg.note}, velocity: {msg.velocity}")
+            if received is not None and latency.monitor.enabled:
+                latency.monitor.since('input', received)
         
         elif msg.type == "note_off":
             self.synth.noteoff(self.active_track, msg.note)
@@ -1,29 +1,146 @@
-import pyaudio
+import time
 import wave
 import threading
+from collections import deque
+
+import numpy as np
+import pyaudio
 
 # audio/Metronomes/Perc_MetronomeQuartz_lo.wav
 # audio/Metronomes/Perc_MetronomeQuartz_hi.wav
 
+def read_wave(path):
+    """
+    Decode a 16 bit PCM wav into a float32 array of shape (frames, channels),
+    plus its sample rate.
+    """
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16 bit wavs are supported")
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        data = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    return data.reshape(-1, channels).astype(np.float32) / 32768, rate
 
 class Metronome:
-    def __init__(self, click_path, clock_path):
+    """
+    Plays the metronome samples, decoded once into memory, through a single
+    callback-mode PyAudio stream that mixes every click itself. No thread is
+    started per beat.
+
+    Clicks are scheduled against the stream's sample clock: click(at) and
+    clock(at) take a time.time() timestamp, converted to a frame using the
+    output time PortAudio reports for each buffer, so a click queued ahead
+    of time starts on the exact frame. Other threads only append to the
+    incoming deque, the audio callback owns everything else.
+    """
+
+    def __init__(self, click_path, clock_path, background=False, frames_per_buffer=256):
         self.click_path = click_path
         self.clock_path = clock_path
+        self.frames_per_buffer = frames_per_buffer
+        self.ready = threading.Event()      # set once the output stream is open
+        self.on_ready = None
+
+        self.p = None
+        self.stream = None
+        self.incoming = deque()             # (samples, time) to play, None to cancel
+        self.voices = []                    # [samples, start frame], owned by the callback
+        self.frame = 0                      # frames rendered so far
+        self.clock_reference = None         # (frame, time.time() it is heard)
+
+        if not background:
+            self.initialise()
+
+    def initialise(self):
+        # opening the audio device can take a while, clicks are dropped until then
+        self.click_samples, self.rate = read_wave(self.click_path)
+        self.clock_samples, clock_rate = read_wave(self.clock_path)
+        if clock_rate != self.rate:
+            raise ValueError("Metronome samples must share a sample rate")
+        self.channels = max(self.click_samples.shape[1], self.clock_samples.shape[1])
+
         self.p = pyaudio.PyAudio()
-        self.stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=44100, output=True)
-        self.click_wave = wave.open(self.click_path, 'rb')
-        self.clock_wave = wave.open(self.clock_path, 'rb')
-    
-    def play_wave(self, wav):
-        wav.rewind()
-        data = wav.readframes(1024)
-        while data:
-            self.stream.write(data)
-            data = wav.readframes(1024)
-
-    def click(self):
-        threading.Thread(target=self.play_wave, args=(self.click_wave,), daemon=True).start()
-
-    def clock(self):
-        threading.Thread(target=self.play_wave, args=(self.clock_wave,), daemon=True).start()
+        self.stream = self.p.open(
+            format=pyaudio.paInt16, channels=self.channels, rate=self.rate, output=True,
+            frames_per_buffer=self.frames_per_buffer, stream_callback=self.callback
+        )
+
+        self.ready.set()
+        if self.on_ready:
+            self.on_ready()
+
+    def callback(self, in_data, frame_count, time_info, status):
+        start = self.frame
+        end = start + frame_count
+
+        # when the first frame of this buffer reaches the speaker
+        latency = time_info['output_buffer_dac_time'] - time_info['current_time']
+        self.clock_reference = (start, time.time() + max(0, latency))
+
+        while self.incoming:
+            item = self.incoming.popleft()
+            if item is None:
+                # cancelled: clicks that have not started yet are dropped
+                self.voices = [voice for voice in self.voices if voice[1] < start]
+                continue
+            samples, at = item
+            self.voices.append([samples, self.frameAt(at, start)])
+
+        out = np.zeros((frame_count, self.channels), dtype=np.float32)
+        playing = []
+
+        for voice in self.voices:
+            samples, voice_start = voice
+            if voice_start >= end:
+                playing.append(voice)
+                continue
+
+            source = start - voice_start if voice_start < start else 0
+            target = voice_start - start if voice_start > start else 0
+            count = min(len(samples) - source, frame_count - target)
+            out[target:target + count] += samples[source:source + count]
+
+            if source + count < len(samples):
+                playing.append(voice)
+
+        self.voices = playing
+        self.frame = end
+
+        np.clip(out, -1, 1, out=out)
+        return ((out * 32767).astype(np.int16).tobytes(), pyaudio.paContinue)
+
+    def frameAt(self, at, start):
+        """
+        The frame heard at time at, never earlier than start.
+        """
+        if at is None or self.clock_reference is None:
+            return start
+        frame, reference_time = self.clock_reference
+        return max(start, frame + int(round((at - reference_time) * self.rate)))
+
+    def play(self, samples, at=None):
+        self.incoming.append((samples, at))
+
+    def click(self, at=None):
+        if self.ready.is_set():
+            self.play(self.click_samples, at)
+
+    def clock(self, at=None):
+        if self.ready.is_set():
+            self.play(self.clock_samples, at)
+
+    def cancel(self):
+        """
+        Drop every click scheduled but not started, used when playback stops.
+        """
+        self.incoming.append(None)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
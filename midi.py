@@ -1,4 +1,19 @@
 import mido
+import numpy as np
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+# message types Looper.update sends to the synth
+PLAYBACK_TYPES = ( "note_on", "note_off", "pitchwheel", "control_change" )
+
+# one row per finished note, times in beats
+NOTE_DTYPE = np.dtype([
+    ("start", np.float64),
+    ("duration", np.float64),
+    ("pitch", np.uint8),
+    ("velocity", np.uint8),
+    ("channel", np.uint8),
+])
 
 def convert_notes_to_abs_time(track):
     acc_ticks = 0
@@ -21,97 +36,114 @@ def convert_notes_to_delta_time(track):
         
     return track
 
-def append_to_file(track, msg, ticks):
+# grid resolutions offered by the quantise dropdown, in divisions per beat
+QUANTISATIONS = ( 0.25, 0.5, 1, 2, 4, 8, 16, 32 )
+
+# loops are split into 4/4 bars for generation and bar selection
+BEATS_PER_BAR = 4
+
+def quantise_grids(beats, quantisations, strength=1.0, swing=0.0):
+    """
+    Snap times in beats to several grids at once.
     
-    track = convert_notes_to_abs_time(track)
-    print(track)
-    msg.time = ticks
-    track.append(msg)
-    track.sort(key=lambda m: m.time)
+    :param beats: array of times in beats
+    :param quantisations: grid resolutions in divisions per beat (0 = off)
+    :param strength: 0-1, how far each time moves towards its grid line
+    :param swing: 0-1, fraction of a grid step every second grid line is delayed by
+    :return: dict of quantisation -> array of quantised times aligned with beats
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    grids = [q for q in quantisations if q != 0]
+    result = { q: beats for q in quantisations if q == 0 }
     
-    track = convert_notes_to_delta_time(track)
-    print(track)
-    print(f"Appended message at {ticks} ticks: {msg}")
+    if not grids:
+        return result
     
-    msg_count = 0
-    for msg in track:
-        msg_count += 1
-        
-    print("Message count", msg_count)
+    # one row per grid, broadcast over every time
+    step = 1.0 / np.asarray(grids, dtype=np.float64)[:, None]
     
-    return track
-    
-def quantise(midi, quantisation):
+    if swing == 0:
+        snapped = np.round(beats / step) * step
+    else:
+        # grid lines come in pairs: on the beat of the pair, then one step later plus swing
+        pair = 2 * step
+        pair_start = np.floor(beats / pair) * pair
+        phase = beats - pair_start
+        swung = step * (1 + swing)
+        candidates = np.stack([np.zeros_like(phase), np.broadcast_to(swung, phase.shape), np.broadcast_to(pair, phase.shape)])
+        nearest = np.argmin(np.abs(candidates - phase), axis=0)
+        snapped = pair_start + np.take_along_axis(candidates, nearest[None], axis=0)[0]
     
-    ticks_per_beat = midi.ticks_per_beat
-    track = midi.tracks[0]
+    quantised = beats + strength * (snapped - beats)
     
-    #print("Ticks per beat:", ticks_per_beat)
+    for index, q in enumerate(grids):
+        result[q] = quantised[index]
+        
+    return result
 
-    #print("Original track:")
-    #for msg in track:
-    #    print(msg)
-    
-    abs_track = []
-    acc_ticks = 0
-    for msg in track:
-        acc_ticks += msg.time
-        msg_copy = msg.copy(time=acc_ticks)
-        abs_track.append(msg_copy)
-        #if msg.type == "end_of_track":
-        #    break
+def quantise_times(beats, quantisation, strength=1.0, swing=0.0):
+    """
+    Snap times in beats to one grid, see quantise_grids.
+    """
+    return quantise_grids(beats, ( quantisation, ), strength, swing)[quantisation]
 
+def quantise_track(track, ticks_per_beat, quantisation, strength=1.0, swing=0.0):
+    """
+    Return a quantised copy of a delta-time MidiTrack. Note starts are moved
+    onto the grid and their note-offs move with them, keeping each note's
+    length; everything else keeps its time.
+    """
+    abs_ticks = np.cumsum([msg.time for msg in track], dtype=np.int64)
+    shift = np.zeros(len(track), dtype=np.int64)
     
-    #print("Absolute track:")
-    #for msg in abs_track:
-    #    print(msg)
-    
-    notes_on = []
-    
-    quantised_messages = []
-    
-    for msg in abs_track:
+    # pair note-offs with their note-ons, oldest first per (channel, pitch)
+    starts = []
+    offs = []
+    notes_on = {}
+    for index, msg in enumerate(track):
         
         if msg.type == "note_on" and msg.velocity > 0:
-            abs_beats = msg.time / ticks_per_beat
-            quantised_start_abs_beats = round(abs_beats * quantisation) / quantisation
-            quantised_start_abs_ticks = int(quantised_start_abs_beats * ticks_per_beat)
-            quantised_messages.append(msg.copy(time=quantised_start_abs_ticks))
-            notes_on.append(msg)
+            starts.append(index)
+            notes_on.setdefault((msg.channel, msg.note), deque()).append(len(starts) - 1)
             
-        elif msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):
-            
-            for note_on in notes_on:
-                
-                if note_on.note == msg.note:
-                    start_abs_ticks = note_on.time
-                    start_abs_beats = start_abs_ticks / ticks_per_beat
-                    end_abs_ticks = msg.time
-                    duration_abs_ticks = int(end_abs_ticks - start_abs_ticks)
-                    quantised_start_abs_beats = round(start_abs_beats * quantisation) / quantisation
-                    quantised_start_abs_ticks = int(quantised_start_abs_beats * ticks_per_beat)
-                    quantised_end_abs_ticks = quantised_start_abs_ticks + duration_abs_ticks
-                    quantised_messages.append(msg.copy(time=quantised_end_abs_ticks))
-                    notes_on.remove(note_on)
-                    break
+        elif msg.type == "note_off" or msg.type == "note_on":
+            held = notes_on.get((msg.channel, msg.note))
+            if held:
+                offs.append((index, held.popleft()))
                 
-        else:
-            quantised_messages.append(msg)
-            
+    if starts:
+        starts = np.asarray(starts)
+        start_ticks = abs_ticks[starts]
+        quantised = quantise_times(start_ticks / ticks_per_beat, quantisation, strength, swing)
+        start_shift = (quantised * ticks_per_beat).astype(np.int64) - start_ticks
+        shift[starts] = start_shift
+        
+        if offs:
+            offs = np.asarray(offs)
+            shift[offs[:, 0]] = start_shift[offs[:, 1]]
     
-    quantised_messages.sort(key=lambda x: x.time)
+    new_ticks = np.maximum(abs_ticks + shift, 0)
+    order = np.argsort(new_ticks, kind="stable")
+    delta = np.diff(new_ticks[order], prepend=0)
     
-    #print("Quantised track:")
-    prev_time = 0
-    for msg in quantised_messages:
-        time = msg.time
-        msg.time -= prev_time
-        prev_time = time
-        #print(msg)
-        
-    quantised_track = mido.MidiTrack(quantised_messages)
+    quantised_track = mido.MidiTrack(
+        track[index].copy(time=int(time)) for index, time in zip(order.tolist(), delta.tolist())
+    )
+    # setting an empty name would add a track_name message the source never had
+    if track.name:
+        quantised_track.name = track.name
+    
+    return quantised_track
+    
+def quantise(midi, quantisation, strength=1.0, swing=0.0):
+    """
+    Return a copy of a MidiFile with every track quantised, see quantise_track.
+    """
+    ticks_per_beat = midi.ticks_per_beat
     quantised_file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
-    quantised_file.tracks.append(quantised_track)
+    
+    for track in midi.tracks:
+        quantised_file.tracks.append(quantise_track(track, ticks_per_beat, quantisation, strength, swing))
     
     return quantised_file
 
@@ -188,18 +220,19 @@ def is_empty_track(track):
 
 class Note:
     
-    def __init__(self, start, duration, pitch, velocity):
+    def __init__(self, start, duration, pitch, velocity, channel=0):
         self.start = start
         self.duration = duration
         self.pitch = pitch
         self.velocity = velocity
+        self.channel = channel
         
 class ControlChange:
     pass
         
 class Track:
     
-    def __init__(self, midi_track=mido.MidiTrack(), ticks_per_beat=480, quantisation=0):
+    def __init__(self, midi_track=None, ticks_per_beat=480, quantisation=0):
         
         if midi_track is None:
             midi_track = mido.MidiTrack()
@@ -209,84 +242,302 @@ class Track:
         #self.track_count = len(midi.tracks)
         #self.track = None
         self.quantisation = quantisation
-        self.notes = []
+        self.strength = 1.0
+        self.swing = 0.0
+        self.version = 0                # bumped whenever the notes change, for caches of them
+        
+        self.read()
+        
+    def read(self):
+        """
+        Parse midi_track in a single pass: absolute times, notes, control
+        changes and the playback index. Note-offs are paired through a
+        (channel, pitch) keyed queue of held notes, so pairing is O(1) however
+        many notes are held.
+        """
+        self.note_rows = []             # notes collected while reading, packed at the end
+        self.note_view = None           # cached Note objects, see notes
+        self.quantised = {}             # cached quantised_starts by (quantisation, strength, swing)
         self.control_changes = []
         self.end_of_track = None
-        self.notes_on = []
+        self.notes_on = {}              # (channel, pitch) -> held notes, oldest first
+        self.note_times = {}            # (channel, pitch) -> beats of its note messages, in track order
+        self.note_messages = {}         # (channel, pitch) -> their messages, aligned with note_times
+        self.abs_ticks = []             # absolute time in ticks of each message in midi_track
+        self.min_pitch = None
+        self.max_pitch = None
+        self.event_beats = []           # playback index, see events_between
+        self.events = []
         
-        print("Reading track")
-        print("Ticks per beat:", self.ticks_per_beat)
+        ticks_per_beat = self.ticks_per_beat
+        abs_ticks = self.abs_ticks
+        event_beats = self.event_beats
+        events = self.events
         
-        delta_time = 0
-        if midi_track is not None:
-            for msg in midi_track:
-                delta_time += msg.time
-                abs_time = delta_time / self.ticks_per_beat
+        acc_ticks = 0
+        for msg in self.midi_track:
+            acc_ticks += msg.time
+            abs_time = acc_ticks / ticks_per_beat
+            abs_ticks.append(acc_ticks)
+            msg_type = msg.type
+            
+            if msg_type in PLAYBACK_TYPES:
+                event_beats.append(abs_time)
+                events.append(msg)
+            
+            if msg.is_meta:
                 
-                if msg.is_meta:
-                    
-                    if msg.type == "end_of_track":
-                        self.end_of_track = abs_time
-                        
-                    if msg.type != "lyrics":
-                        print(msg)
-                    
-                elif msg.type == "note_on" and msg.velocity > 0:
-                    
-                    #print("Note on:", msg.note, msg.velocity, abs_time)
-                    #if abs_time > length:
-                    #    print("Note on after end of track", abs_time, length)
-                    #    continue
-                    
-                    
-                    self.notes_on.append(Note(abs_time, None, msg.note, msg.velocity))
+                if msg_type == "end_of_track":
+                    self.end_of_track = abs_time
+                
+            elif msg_type == "note_on" or msg_type == "note_off":
+                key = (msg.channel, msg.note)
+                times = self.note_times.get(key)
+                if times is None:
+                    times = self.note_times[key] = []
+                    self.note_messages[key] = []
+                times.append(abs_time)
+                self.note_messages[key].append(msg)
+                
+                if msg_type == "note_on" and msg.velocity > 0:
+                    self.open_note(msg, abs_time)
+                else:
+                    self.close_note(msg, abs_time)
                     
-                elif msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):
-                        
-                    for note in self.notes_on:
-
-                        if note.pitch == msg.note:
-                            note.duration = abs_time - note.start
-                            if self.quantisation != 0:
-                                note.start = round(note.start * self.quantisation) / self.quantisation
-                            self.notes.append(note)
-                            self.notes_on.remove(note)
-                            break
-                        
-                elif msg.type == "control_change":
-                        
-                    self.control_changes.append
-                    (
-                        {
-                            "control": msg.control, 
-                            "value": msg.value, 
-                            "time": msg.time, 
-                            "abs_time": abs_time
-                        }
-                    )
-            
-            print("Remaining notes on:", len(self.notes_on))
-        # add any remaining notes that are still on
-        #for note in self.notes_on:
-        #    print("Adding note:", note)
-        #    note.duration = length - note.start
-        #    self.notes.append(note)
+            elif msg_type == "control_change":
+                self.control_changes.append(
+                    {
+                        "control": msg.control, 
+                        "value": msg.value, 
+                        "time": msg.time, 
+                        "abs_time": abs_time
+                    }
+                )
                 
+        self.note_buffer = np.array(self.note_rows, dtype=NOTE_DTYPE)
+        self.note_count = len(self.note_rows)
+        self.note_rows = None
+        self.version += 1
+        
+        self.update_range()
+        
+    def open_note(self, msg, abs_time):
+        key = (msg.channel, msg.note)
+        held = self.notes_on.get(key)
+        if held is None:
+            held = self.notes_on[key] = deque()
+        held.append(Note(abs_time, None, msg.note, msg.velocity, msg.channel))
+        
+    def close_note(self, msg, abs_time):
+        """
+        Pair a note-off with the earliest held note of the same channel and
+        pitch and move it to notes. Returns the finished Note, or None if
+        nothing was held.
+        """
+        held = self.notes_on.get((msg.channel, msg.note))
+        
+        # a recorded note-off that wrapped past the loop end is left unpaired
+        if not held or held[0].start > abs_time:
+            return None
+        
+        note = held.popleft()
+        note.duration = abs_time - note.start
+        self.append_note(note)
+        
+        if self.min_pitch is None or note.pitch < self.min_pitch:
+            self.min_pitch = note.pitch
+        if self.max_pitch is None or note.pitch > self.max_pitch:
+            self.max_pitch = note.pitch
+            
+        return note
+        
+    def append_note(self, note):
+        row = (note.start, note.duration, note.pitch, note.velocity, note.channel)
+        
+        if self.note_rows is not None:
+            self.note_rows.append(row)
+            return
+        
+        self.append_row(row)
+        
+    def append_row(self, row):
+        if self.note_count == len(self.note_buffer):
+            # grow geometrically so appends stay amortised O(1)
+            buffer = np.empty(max(64, len(self.note_buffer) * 2), dtype=NOTE_DTYPE)
+            buffer[:self.note_count] = self.note_buffer[:self.note_count]
+            self.note_buffer = buffer
+            
+        self.note_buffer[self.note_count] = row
+        self.note_count += 1
+        self.version += 1
+        self.note_view = None
+        self.quantised = {}
+        
+    @property
+    def note_array(self):
+        """
+        The finished notes as a NumPy structured array with start, duration,
+        pitch, velocity and channel columns (see NOTE_DTYPE).
+        """
+        return self.note_buffer[:self.note_count]
+    
+    @property
+    def notes(self):
+        """
+        The finished notes as Note objects, built from note_array on first use
+        after a change. Prefer note_array for anything that loops over notes.
+        """
+        if self.note_view is None:
+            notes = self.note_array
+            self.note_view = [
+                Note(float(start), float(duration), int(pitch), int(velocity), int(channel))
+                for start, duration, pitch, velocity, channel in zip(
+                    notes["start"], notes["duration"], notes["pitch"], notes["velocity"], notes["channel"]
+                )
+            ]
+        return self.note_view
+    
+    def quantised_starts(self, quantisation=None):
+        """
+        Note start times in beats snapped to 1/quantisation of a beat, as an
+        array aligned with note_array. Defaults to the track's quantisation.
+        The first call after a change computes every grid in QUANTISATIONS in
+        one pass, so switching grids afterwards is a lookup.
+        """
+        if quantisation is None:
+            quantisation = self.quantisation
+        if quantisation == 0:
+            return self.note_array["start"]
+        
+        key = (quantisation, self.strength, self.swing)
+        starts = self.quantised.get(key)
+        if starts is None:
+            grids = set(QUANTISATIONS)
+            grids.add(quantisation)
+            for q, starts in quantise_grids(self.note_array["start"], grids, self.strength, self.swing).items():
+                self.quantised[(q, self.strength, self.swing)] = starts
+            starts = self.quantised[key]
+            
+        return starts
+        
+    def update_range(self):
+        """
+        Set lowest_note and highest_note, the pitch range drawn by the
+        timeline, padded out to at least an octave each way.
+        """
         self.lowest_note = 0
         self.highest_note = 127
         
-        if self.notes:
-            self.lowest_note = min(note.pitch for note in self.notes)
-            self.highest_note = max(note.pitch for note in self.notes)
+        if self.min_pitch is not None:
+            self.lowest_note = self.min_pitch
+            self.highest_note = self.max_pitch
         
         range = self.highest_note - self.lowest_note
         
         if range < 12:
             self.lowest_note -= 12 - range
             self.highest_note += 12 - range
+            
+    def record(self, msg, ticks):
+        """
+        Insert a copy of msg at absolute time ticks, keeping midi_track in
+        delta time. The insert position is found with a binary search and only
+        the new message and the one after it are re-timed; the notes, pitch
+        range and playback index are updated in place instead of re-reading
+        the whole track. The list inserts themselves are memmoves, so a
+        record is O(n) in the message count with a small constant, plus
+        O(messages of that note) when it has to be paired again. Returns the
+        inserted message.
+        """
+        index = bisect_right(self.abs_ticks, ticks)
+        prev_ticks = self.abs_ticks[index - 1] if index > 0 else 0
+        
+        msg = msg.copy(time=ticks - prev_ticks)
+        
+        if index < len(self.midi_track):
+            self.midi_track[index].time = self.abs_ticks[index] - ticks
         
-        print("Number of notes:", len(self.notes))
-        print("Highest note:", self.highest_note)
-        print("Lowest note:", self.lowest_note)    
-        print("End of track:", self.end_of_track)
+        self.midi_track.insert(index, msg)
+        self.abs_ticks.insert(index, ticks)
+        
+        abs_time = ticks / self.ticks_per_beat
+        
+        if msg.type in PLAYBACK_TYPES:
+            position = bisect_right(self.event_beats, abs_time)
+            self.events.insert(position, msg)
+            self.event_beats.insert(position, abs_time)
+        
+        if msg.type == "note_on" or msg.type == "note_off":
+            key = (msg.channel, msg.note)
+            times = self.note_times.get(key)
+            if times is None:
+                times = self.note_times[key] = []
+                self.note_messages[key] = []
+            position = bisect_right(times, abs_time)
+            times.insert(position, abs_time)
+            self.note_messages[key].insert(position, msg)
+            
+            if position < len(times) - 1:
+                # landed before later messages of the same note (an overdub
+                # after a loop wrap): pair it again in time order, as read() does
+                self.repair_notes(key)
+                
+            elif msg.type == "note_on" and msg.velocity > 0:
+                self.open_note(msg, abs_time)
+                
+            elif self.close_note(msg, abs_time) is not None:
+                self.update_range()
+            
+        return msg
+        
+    def repair_notes(self, key):
+        """
+        Pair the note messages of one (channel, pitch) again from scratch in
+        time order, replacing its finished and held notes. Only that note's
+        rows of note_buffer are rewritten, in place; the rest of the track
+        is not copied unless the note ends up with fewer rows.
+        """
+        notes = self.note_array
+        rows = np.flatnonzero((notes["channel"] == key[0]) & (notes["pitch"] == key[1]))
+        self.notes_on.pop(key, None)
+        
+        # collect the re-paired rows instead of appending them
+        self.note_rows = []
+        for abs_time, msg in zip(self.note_times[key], self.note_messages[key]):
+            if msg.type == "note_on" and msg.velocity > 0:
+                self.open_note(msg, abs_time)
+            else:
+                self.close_note(msg, abs_time)
+        new_rows, self.note_rows = self.note_rows, None
+        
+        shared = min(len(rows), len(new_rows))
+        for position, row in zip(rows[:shared], new_rows[:shared]):
+            self.note_buffer[position] = row
+        for row in new_rows[shared:]:
+            self.append_row(row)
+        if len(rows) > shared:
+            self.note_buffer = np.delete(notes, rows[shared:])
+            self.note_count = len(self.note_buffer)
+            
+        self.version += 1
+        self.note_view = None
+        self.quantised = {}
+        self.update_range()
+        
+    def events_between(self, start, end):
+        """
+        Return the playable messages with start <= beats < end, using a binary
+        search over the playback index.
+        """
+        lo, hi = self.event_range(start, end)
+        return self.events[lo:hi]
+    
+    def event_range(self, start, end):
+        """
+        Return the (lo, hi) slice of events and event_beats with
+        start <= beats < end.
+        """
+        lo = bisect_left(self.event_beats, start)
+        hi = bisect_left(self.event_beats, end, lo)
+        return lo, hi
         
\ No newline at end of file
@@ -0,0 +1,170 @@
+import os
+import wave
+import argparse
+import multiprocessing
+
+import mido
+import numpy as np
+
+from midi import Track
+from soundfont_index import SoundFontIndex
+
+SAMPLE_RATE = 44100
+TAIL_SECONDS = 2.0          # rendered after the last loop so notes can ring out
+CHUNK_FRAMES = 4096         # most frames asked of fluidsynth at once
+
+def track_events(track):
+    """
+    (beat, message) pairs of a track's playable events, as the looper
+    plays them.
+    """
+    return list(zip(track.event_beats, track.events))
+
+def play_message(synth, channel, msg):
+    if msg.type == "note_on":
+        synth.noteon(channel, msg.note, msg.velocity)
+
+    elif msg.type == "note_off":
+        synth.noteoff(channel, msg.note)
+
+    elif msg.type == "pitchwheel":
+        synth.pitch_bend(channel, msg.pitch)
+
+    elif msg.type == "control_change":
+        synth.cc(channel, msg.control, msg.value)
+
+def render_job(job):
+    """
+    Render one WAV file in this process with its own driverless synth.
+
+    job is a dict with path, beats, bpm, loops, soundfont_dir, soundfonts
+    (the entries of a SoundFontIndex already scanned) and channels, a list
+    of (channel, events, program, volume) where program is (soundfont,
+    bank, preset) or None for the default soundfont. Returns the path and
+    the number of frames written.
+    """
+    from synth import DefaultSynth
+
+    synth = DefaultSynth(job['soundfont_dir'], background=True, samplerate=float(SAMPLE_RATE))
+    # the parent scanned the index, so workers never write it concurrently
+    synth.index.entries = job['soundfonts']
+    synth.initialise(driver=None, scan=False)
+
+    timeline = []
+    for channel, events, program, volume in job['channels']:
+        if program is not None:
+            synth.assignSoundFont(channel, *program)
+        synth.cc(channel, 7, volume)
+        timeline.extend((beat, channel, msg) for beat, msg in events)
+    timeline.sort(key=lambda event: event[0])
+
+    frames_per_beat = SAMPLE_RATE * 60 / job['bpm']
+    loop_frames = job['beats'] * frames_per_beat
+
+    chunks = []
+    position = 0
+
+    def render_until(frame):
+        nonlocal position
+        while position < frame:
+            count = min(CHUNK_FRAMES, frame - position)
+            chunks.append(synth.get_samples(count))
+            position += count
+
+    for loop in range(job['loops']):
+        offset = loop * loop_frames
+        for beat, channel, msg in timeline:
+            render_until(int(offset + beat * frames_per_beat))
+            play_message(synth, channel, msg)
+
+    for channel, _, _, _ in job['channels']:
+        synth.all_notes_off(channel)
+    render_until(int(job['loops'] * loop_frames + TAIL_SECONDS * SAMPLE_RATE))
+
+    synth.delete()
+
+    samples = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
+    write_wav(job['path'], samples.astype(np.int16), SAMPLE_RATE)
+    return job['path'], len(samples) // 2
+
+def write_wav(path, samples, rate, channels=2):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.tobytes())
+
+def bounce(tracks, beats, bpm, out_dir, loops=1, stems=False, mix=True,
+           programs=None, volumes=None, soundfont_dir="soundfonts", processes=None):
+    """
+    Render the tracks offline, as fast as the CPU allows, to mix.wav and/or
+    one track_<n>.wav stem per non-empty track in out_dir. Every file is
+    rendered by its own worker process, so stems render in parallel.
+
+    programs maps a track to (soundfont, bank, preset) and volumes to a
+    0-127 channel volume; tracks without one get the synth defaults.
+    Returns a list of (path, frames).
+    """
+    programs = programs or {}
+    volumes = volumes or {}
+    os.makedirs(out_dir, exist_ok=True)
+
+    # the looper only plays what falls inside the loop
+    channels = []
+    for index, track in enumerate(tracks):
+        if track is None:
+            continue
+        events = [(beat, msg) for beat, msg in track_events(track) if beat < beats]
+        if events:
+            channels.append((index, events, programs.get(index), volumes.get(index, 127)))
+
+    index = SoundFontIndex(soundfont_dir)
+    index.scan()
+
+    job = {'beats': beats, 'bpm': bpm, 'loops': loops, 'soundfont_dir': soundfont_dir, 'soundfonts': index.entries}
+    jobs = []
+    if mix:
+        jobs.append(dict(job, path=os.path.join(out_dir, "mix.wav"), channels=channels))
+    if stems:
+        for channel in channels:
+            jobs.append(dict(job, path=os.path.join(out_dir, f"track_{channel[0]}.wav"), channels=[channel]))
+
+    if not jobs:
+        return []
+    if len(jobs) == 1:
+        return [render_job(jobs[0])]
+
+    # spawn so the workers never inherit an audio driver or the GUI
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes or min(len(jobs), os.cpu_count() or 1)) as pool:
+        return pool.map(render_job, jobs)
+
+def bounce_looper(looper, out_dir, loops=1, stems=False, mix=True, processes=None):
+    """
+    bounce() the audible tracks of a Looper with its soundfonts and volumes.
+    """
+    tracks = [track if looper.isAudible(i) else None for i, track in enumerate(looper.tracks)]
+    programs = dict(getattr(looper.synth, "channel_programs", {}))
+    volumes = dict(enumerate(looper.volumes))
+    return bounce(tracks, looper.beats, looper.bpm, out_dir, loops, stems, mix, programs, volumes,
+                  looper.synth.default_dir, processes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a looper session to WAV without an audio device")
+    parser.add_argument("midi", help="MIDI file with one track per looper track, as Looper.export writes")
+    parser.add_argument("out_dir")
+    parser.add_argument("--beats", type=int, default=16, help="loop length in beats")
+    parser.add_argument("--bpm", type=float, default=120)
+    parser.add_argument("--loops", type=int, default=1, help="loop repetitions to render")
+    parser.add_argument("--stems", action="store_true", help="also render one file per track")
+    parser.add_argument("--no-mix", action="store_true", help="skip the full mix")
+    parser.add_argument("--soundfonts", default="soundfonts")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    midi = mido.MidiFile(args.midi)
+    tracks = [Track(midi_track, midi.ticks_per_beat) for midi_track in midi.tracks]
+
+    for path, frames in bounce(tracks, args.beats, args.bpm, args.out_dir, args.loops, args.stems, not args.no_mix,
+                               soundfont_dir=args.soundfonts, processes=args.processes):
+        print(f"Wrote {path} ({frames / SAMPLE_RATE:.2f} seconds)")
@@ -0,0 +1,149 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+from midi import NOTE_DTYPE
+
+class SnapshotTrack:
+    """
+    Read-only view of one track of a SessionSnapshot. Has the note_array of
+    a Track, which is all generation reads from a track.
+    """
+
+    __slots__ = ("note_array",)
+
+    def __init__(self, note_array):
+        self.note_array = note_array
+
+    @property
+    def note_count(self):
+        return len(self.note_array)
+
+class SessionSnapshot:
+    """
+    Immutable copy of what a generation needs from the looper: the notes of
+    every track packed into one NOTE_DTYPE array, the tempo, the loop length
+    and the active track. It is the only thing sent to the generation
+    process, so starting a generation costs O(notes) and never touches the
+    synth, the metronome or any callback.
+
+    Track i owns notes[offsets[i]:offsets[i + 1]]; tracks that do not exist
+    are marked in present. share() puts the arrays in shared memory so the
+    worker reads them without a copy.
+    """
+
+    __slots__ = ("notes", "offsets", "present", "beats", "bpm", "active_track")
+
+    def __init__(self, notes, offsets, present, beats, bpm, active_track):
+        for array in (notes, offsets, present):
+            array.flags.writeable = False
+        object.__setattr__(self, "notes", notes)
+        object.__setattr__(self, "offsets", offsets)
+        object.__setattr__(self, "present", present)
+        object.__setattr__(self, "beats", beats)
+        object.__setattr__(self, "bpm", bpm)
+        object.__setattr__(self, "active_track", active_track)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SessionSnapshot is immutable")
+
+    def __reduce__(self):
+        return (SessionSnapshot, (self.notes, self.offsets, self.present, self.beats, self.bpm, self.active_track))
+
+    @classmethod
+    def from_tracks(cls, tracks, beats, bpm, active_track):
+        arrays = [track.note_array for track in tracks if track is not None]
+        notes = np.concatenate(arrays) if arrays else np.empty(0, dtype=NOTE_DTYPE)
+
+        counts = [0 if track is None else track.note_count for track in tracks]
+        offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        present = np.array([track is not None for track in tracks], dtype=np.bool_)
+
+        return cls(notes, offsets, present, beats, bpm, active_track)
+
+    @classmethod
+    def from_looper(cls, looper):
+        return cls.from_tracks(looper.tracks, looper.beats, looper.bpm, looper.active_track)
+
+    def track_count(self):
+        return len(self.present)
+
+    def tracks(self):
+        """
+        The tracks as SnapshotTrack views into notes (None where the looper
+        had no track), in the shape generate() takes.
+        """
+        return [
+            SnapshotTrack(self.notes[self.offsets[i]:self.offsets[i + 1]]) if self.present[i] else None
+            for i in range(len(self.present))
+        ]
+
+    def share(self):
+        """
+        Copy the arrays into a new shared memory block and return a
+        SharedSnapshot handle for it. The caller owns the block and must
+        release() it once the other process is done with it.
+        """
+        size = self.notes.nbytes + self.offsets.nbytes + self.present.nbytes
+        block = shared_memory.SharedMemory(create=True, size=max(1, size))
+
+        position = 0
+        for array in (self.notes, self.offsets, self.present):
+            target = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, offset=position)
+            target[:] = array
+            position += array.nbytes
+        del target
+
+        return SharedSnapshot(block, len(self.notes), len(self.present), self.beats, self.bpm, self.active_track)
+
+class SharedSnapshot:
+    """
+    Picklable handle on a SessionSnapshot held in shared memory. Only the
+    block name and the sizes are pickled; attach() maps the block and
+    returns a snapshot viewing it without copying.
+    """
+
+    def __init__(self, block, note_count, track_count, beats, bpm, active_track):
+        self.block = block
+        self.name = block.name
+        self.note_count = note_count
+        self.track_count = track_count
+        self.beats = beats
+        self.bpm = bpm
+        self.active_track = active_track
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["block"] = None
+        return state
+
+    def attach(self):
+        if self.block is None:
+            self.block = shared_memory.SharedMemory(name=self.name)
+
+        buffer = self.block.buf
+        notes = np.ndarray(self.note_count, dtype=NOTE_DTYPE, buffer=buffer)
+        position = notes.nbytes
+        offsets = np.ndarray(self.track_count + 1, dtype=np.int64, buffer=buffer, offset=position)
+        position += offsets.nbytes
+        present = np.ndarray(self.track_count, dtype=np.bool_, buffer=buffer, offset=position)
+
+        return SessionSnapshot(notes, offsets, present, self.beats, self.bpm, self.active_track)
+
+    def detach(self):
+        """
+        Unmap the block in this process. Every snapshot returned by attach()
+        must be gone by now.
+        """
+        if self.block is not None:
+            self.block.close()
+            self.block = None
+
+    def release(self):
+        """
+        Unmap and free the block, called by the process that shared it.
+        """
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
@@ -0,0 +1,125 @@
+import os
+import json
+import struct
+
+# one phdr record: name, preset, bank, bag index, library, genre, morphology
+PRESET_HEADER = struct.Struct("<20sHHHIII")
+
+def read_presets(path):
+    """
+    Read the (bank, preset, name) list of an SF2 file from its pdta chunk,
+    seeking past the sample data so nothing big is read.
+    """
+    presets = []
+
+    with open(path, "rb") as f:
+        riff, size, form = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or form != b"sfbk":
+            raise ValueError(f"{path} is not a SoundFont 2 file")
+        end = 8 + size
+
+        while f.tell() + 8 <= end:
+            chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+            chunk_end = f.tell() + chunk_size + (chunk_size & 1)
+
+            if chunk_id == b"LIST" and f.read(4) == b"pdta":
+                while f.tell() + 8 <= chunk_end:
+                    sub_id, sub_size = struct.unpack("<4sI", f.read(8))
+                    if sub_id != b"phdr":
+                        f.seek(sub_size + (sub_size & 1), os.SEEK_CUR)
+                        continue
+
+                    data = f.read(sub_size)
+                    # the last record is the EOP terminator
+                    for offset in range(0, sub_size - PRESET_HEADER.size, PRESET_HEADER.size):
+                        name, preset, bank, _, _, _, _ = PRESET_HEADER.unpack_from(data, offset)
+                        name = name.split(b"\0", 1)[0].decode("latin-1").strip()
+                        presets.append((bank, preset, name))
+                    break
+
+            f.seek(chunk_end)
+
+    presets.sort()
+    return presets
+
+class SoundFontIndex:
+    """
+    Banks and presets of every soundfont under a directory, without loading
+    any samples. The index is cached as JSON next to the soundfonts, and a
+    file is only read again when its mtime or size changes.
+
+    Soundfonts are named by their path relative to the directory, without
+    the extension, as DefaultSynth names them.
+    """
+
+    def __init__(self, directory="soundfonts", extension=".sf2", cache_name=".index.json"):
+        self.directory = directory
+        self.extension = extension
+        self.cache_path = os.path.join(directory, cache_name)
+        self.entries = {}       # name -> {'mtime', 'size', 'presets': [[bank, preset, name], ...]}
+
+    def load(self):
+        try:
+            with open(self.cache_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(self.entries, f)
+        except OSError as e:
+            print(f"Could not write soundfont index: {e}")
+
+    def scan(self):
+        """
+        Bring the index up to date with the directory, reading only new or
+        changed files. Returns the number of files read.
+        """
+        self.load()
+
+        entries = {}
+        read = 0
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                if not file.endswith(self.extension):
+                    continue
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, self.directory)[:-len(self.extension)]
+                stat = os.stat(path)
+
+                entry = self.entries.get(name)
+                if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                    try:
+                        presets = read_presets(path)
+                    except (OSError, ValueError, struct.error) as e:
+                        print(f"Skipping soundfont {path}: {e}")
+                        continue
+                    entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'presets': presets}
+                    read += 1
+
+                entries[name] = entry
+
+        changed = read > 0 or entries.keys() != self.entries.keys()
+        self.entries = entries
+        if changed:
+            self.save()
+
+        print(f"Indexed {len(entries)} soundfonts ({read} read)")
+        return read
+
+    def names(self):
+        return sorted(self.entries)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.extension)
+
+    def presets(self, name):
+        """
+        (bank, preset, preset name) tuples of a soundfont, sorted.
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return []
+        return [tuple(preset) for preset in entry['presets']]
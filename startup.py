@@ -0,0 +1,30 @@
+import time
+
+class StartupProfile:
+    """
+    Milestones of application start-up, in milliseconds since this module
+    was first imported (app.py imports it before anything heavy). Marks may
+    come from any thread.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+
+    def mark(self, name):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.marks.append((elapsed, name))
+        print(f"[startup] {name}: {elapsed:.1f} ms")
+
+    def has(self, name):
+        return any(mark_name == name for _, mark_name in self.marks)
+
+    def report(self):
+        print("Startup profile")
+        print(f"{'ms':>9} {'+ms':>9}  milestone")
+        previous = 0
+        for elapsed, name in sorted(self.marks):
+            print(f"{elapsed:>9.1f} {elapsed - previous:>9.1f}  {name}")
+            previous = elapsed
+
+profile = StartupProfile()
@@ -1,55 +1,243 @@
 import os
+import time
+import queue
+import threading
+from collections import deque
+
 import fluidsynth
 
+from soundfont_index import SoundFontIndex
+
+class ProgramSwitch:
+    """
+    A soundfont change requested for a track, waiting for its soundfont to
+    load and then for the next beat (or loop, if boundary is "loop").
+    """
+
+    def __init__(self, track_number, name, bank, preset, boundary="beat"):
+        self.track_number = track_number
+        self.name = name
+        self.bank = bank
+        self.preset = preset
+        self.boundary = boundary
+        self.sfid = None
+        self.requested = time.time()
+        self.loaded = None
+
 class DefaultSynth(fluidsynth.Synth):
     
-    def __init__(self, default_dir="soundfonts", default_ext=".sf2"):
-        super().__init__()
+    def __init__(self, default_dir="soundfonts", default_ext=".sf2", background=False, **settings):
+        super().__init__(**settings)
         self.default_dir = default_dir
         self.default_ext = default_ext
-        self.start(driver='alsa')
-        self.sfids = {}       
+        self.index = SoundFontIndex(default_dir, default_ext)
+        self.sfids = {}             # resident soundfont name -> sfid
+        self.refcounts = {}         # resident soundfont name -> channels using it
+        self.channel_fonts = {}     # channel -> soundfont name
+        self.channel_programs = {}  # channel -> (soundfont name, bank, preset)
+        self.font_lock = threading.Lock()
+        
+        # soundfont switches are loaded off the GUI thread and applied on a boundary
+        self.load_queue = queue.Queue()
+        self.loader = None
+        self.ready_switches = {}    # track number -> loaded ProgramSwitch
+        self.switch_lock = threading.Lock()
+        self.switch_times = deque(maxlen=64)    # seconds from selection to audible
+        self.on_switch_ready = None
+        
+        # set once the audio driver runs and the soundfonts are indexed
+        self.ready = threading.Event()
+        self.on_ready = None
         
-        self.loadAllFonts(self.default_dir)
+        if not background:
+            self.initialise()
+            
+    def initialise(self, driver='alsa', scan=True):
+        """
+        Start the audio driver, index the soundfonts and load the default
+        one. Slow, so it may run on a background thread; on_ready is called
+        from that thread. With driver None nothing is opened and audio is
+        pulled with get_samples, for offline rendering. With scan False the
+        index is used as the caller filled it in, and never written.
+        """
+        if driver is not None:
+            self.start(driver=driver)
+        if scan:
+            self.index.scan()
          
         for i in range(16):
             self.assignDefaultSoundFont(i)
             
-    def loadAllFonts(self, dir):
-        for root, dirs, files in os.walk(dir):
-            for file in files:
-                path = os.path.join(root, file)
-                # remove the directory prefix
-                path = path[len(dir) + 1:]
-                if path.endswith(self.default_ext):
-                    self.loadSoundFont(path)
-                    
-    def loadSoundFont(self, path):
-        without_ext = path[:-len(self.default_ext)]
-        lookup = self.sfids.get(without_ext)
-        if lookup is not None:
-            return lookup
-        sfid = self.sfload(os.path.join(self.default_dir, path))
-        if sfid == -1:
-            return None
-        self.sfids[without_ext] = sfid
-        print(f"Loaded soundfont {path} with sfid {sfid}")
-        return sfid
+        self.ready.set()
+        if self.on_ready:
+            self.on_ready()
+            
+    def loadSoundFont(self, name):
+        """
+        Load a soundfont by name if it is not resident yet and take a
+        reference on it. Returns its sfid, or None if it cannot be loaded.
+        """
+        with self.font_lock:
+            sfid = self.sfids.get(name)
+            if sfid is None:
+                sfid = self.sfload(self.index.path(name))
+                if sfid == -1:
+                    return None
+                self.sfids[name] = sfid
+                print(f"Loaded soundfont {name} with sfid {sfid}")
+            self.refcounts[name] = self.refcounts.get(name, 0) + 1
+            return sfid
+        
+    def releaseSoundFont(self, name):
+        """
+        Drop a reference taken by loadSoundFont, unloading the soundfont
+        once no track uses it.
+        """
+        with self.font_lock:
+            count = self.refcounts.get(name, 0) - 1
+            if count > 0:
+                self.refcounts[name] = count
+                return
+            self.refcounts.pop(name, None)
+            sfid = self.sfids.pop(name, None)
+            if sfid is not None:
+                self.sfunload(sfid)
+                print(f"Unloaded soundfont {name}")
     
     def listLoadedSoundFonts(self):
         return self.sfids.keys()
     
+    def listSoundFonts(self):
+        return self.index.names()
+    
+    def listPresets(self):
+        """
+        (soundfont, bank, preset, preset name) for every preset in the
+        index, for menus. Nothing is loaded.
+        """
+        return [
+            (name, bank, preset, preset_name)
+            for name in self.index.names()
+            for bank, preset, preset_name in self.index.presets(name)
+        ]
+    
     def assignDefaultSoundFont(self, track_number):
-        if len(self.sfids) == 0:
-            print("No soundfonts loaded")
+        names = self.index.names()
+        if len(names) == 0:
+            print("No soundfonts found")
             return
-        path = next(iter(self.sfids))# + self.default_ext
-        self.assignSoundFont(track_number, path)
+        self.assignSoundFont(track_number, names[0])
     
-    def assignSoundFont(self, track_number, path):
-        path += self.default_ext
-        sfid = self.loadSoundFont(path)
+    def assignSoundFont(self, track_number, name, bank=None, preset=None):
+        """
+        Play track_number with a preset of a soundfont, its first preset if
+        none is given, loading the soundfont on first use and unloading the
+        track's previous one if nothing else uses it.
+        """
+        if bank is None or preset is None:
+            presets = self.index.presets(name)
+            bank, preset = presets[0][:2] if presets else (0, 0)
+            
+        sfid = self.loadSoundFont(name)
         if sfid is None:
             return
-        self.program_select(track_number, sfid, 0, 0)
-        print(f"Assigned soundfont {path} to track {track_number}")
\ No newline at end of file
+        self.program_select(track_number, sfid, bank, preset)
+        
+        previous = self.channel_fonts.get(track_number)
+        self.channel_fonts[track_number] = name
+        self.channel_programs[track_number] = (name, bank, preset)
+        if previous is not None:
+            self.releaseSoundFont(previous)
+            
+        print(f"Assigned soundfont {name} {bank}:{preset} to track {track_number}")
+        
+    def requestSoundFont(self, track_number, name, bank=None, preset=None, boundary="beat"):
+        """
+        Switch a track to a soundfont without stalling playback: the
+        soundfont is loaded on a background thread and the program change
+        is applied by whoever plays the loop at the next beat (or loop)
+        boundary once it is resident. on_switch_ready(track_number) is
+        called from the loader thread when it is.
+        """
+        if bank is None or preset is None:
+            presets = self.index.presets(name)
+            bank, preset = presets[0][:2] if presets else (0, 0)
+        
+        if self.loader is None:
+            self.loader = threading.Thread(target=self.runLoader, name="soundfont-loader", daemon=True)
+            self.loader.start()
+            
+        self.load_queue.put(ProgramSwitch(track_number, name, bank, preset, boundary))
+        
+    def runLoader(self):
+        while True:
+            switch = self.load_queue.get()
+            
+            switch.sfid = self.loadSoundFont(switch.name)
+            if switch.sfid is None:
+                print(f"Could not load soundfont {switch.name}")
+                continue
+            switch.loaded = time.time()
+            
+            # a newer selection for the track replaces one not applied yet
+            with self.switch_lock:
+                replaced = self.ready_switches.get(switch.track_number)
+                self.ready_switches[switch.track_number] = switch
+            if replaced is not None:
+                self.releaseSoundFont(replaced.name)
+                
+            if self.on_switch_ready:
+                self.on_switch_ready(switch.track_number)
+                
+    def takeSwitches(self, loop_boundary=False):
+        """
+        Remove and return the loaded switches due at a boundary: all of them
+        at a loop boundary, the ones waiting for a beat otherwise.
+        """
+        if not self.ready_switches:
+            return []
+        with self.switch_lock:
+            due = [
+                switch for switch in self.ready_switches.values() 
+                if loop_boundary or switch.boundary == "beat"
+            ]
+            for switch in due:
+                del self.ready_switches[switch.track_number]
+        return due
+    
+    def applySwitch(self, switch):
+        """
+        Select the switch's program now and finish it.
+        """
+        self.program_select(switch.track_number, switch.sfid, switch.bank, switch.preset)
+        self.switchApplied(switch)
+        
+    def switchApplied(self, switch):
+        """
+        Bookkeeping once a switch is audible: release the track's previous
+        soundfont and record the time from selection to audible.
+        """
+        previous = self.channel_fonts.get(switch.track_number)
+        self.channel_fonts[switch.track_number] = switch.name
+        self.channel_programs[switch.track_number] = (switch.name, switch.bank, switch.preset)
+        if previous is not None:
+            self.releaseSoundFont(previous)
+            
+        elapsed = time.time() - switch.requested
+        self.switch_times.append(elapsed)
+        print(f"Soundfont {switch.name} {switch.bank}:{switch.preset} audible on track {switch.track_number} "
+              f"{elapsed * 1000:.0f} ms after selection (loaded in {(switch.loaded - switch.requested) * 1000:.0f} ms)")
+        
+    def switchStats(self):
+        """
+        Selection to audible times of the recent switches, in seconds.
+        """
+        times = sorted(self.switch_times)
+        if not times:
+            return {'count': 0}
+        return {
+            'count': len(times), 
+            'median': times[len(times) // 2], 
+            'max': times[-1], 
+            'last': self.switch_times[-1]
+        }
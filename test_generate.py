@@ -0,0 +1,74 @@
+import mido
+
+from midi import Track
+from generate import generate, session_key, splice_bars, StubBackend
+
+def make_track(events, ticks_per_beat=480):
+    """
+    A Track from (beats, message) pairs.
+    """
+    midi_track = mido.MidiTrack()
+    previous = 0
+    for beats, msg in sorted(events, key=lambda e: e[0]):
+        ticks = int(round(beats * ticks_per_beat))
+        midi_track.append(msg.copy(time=ticks - previous))
+        previous = ticks
+    return Track(midi_track, ticks_per_beat)
+
+def note(start, end, pitch, velocity=80):
+    return [(start, mido.Message("note_on", note=pitch, velocity=velocity)),
+            (end, mido.Message("note_off", note=pitch, velocity=0))]
+
+def held_notes(track):
+    return sum(len(held) for held in track.notes_on.values())
+
+def test_note_crossing_into_selection_is_closed():
+    # held from bar 0 into bar 1, which is regenerated
+    original = make_track(note(2, 6, 60) + note(9, 10, 64))
+    candidate = generate([original], 16, 0, bars=(1, 2), backend=StubBackend())[0][0]
+
+    assert held_notes(candidate) == 0
+    onsets = [msg for msg in candidate.events if msg.type == "note_on" and msg.velocity > 0]
+    assert candidate.note_count == len(onsets)
+
+    spliced = splice_bars(original, candidate, (1, 2), 16)
+    assert held_notes(spliced) == 0
+    first = spliced.note_array[0]
+    assert (first["start"], first["duration"], first["pitch"]) == (2, 2, 60)
+
+def test_splice_keeps_unselected_bars_exactly():
+    events = note(0.5292, 1.2292, 30) + note(12.2292, 13.5, 100)
+    events.append((0.25, mido.Message("control_change", control=64, value=127)))
+    events.append((13.9, mido.Message("control_change", control=64, value=0)))
+    original = make_track(events)
+    candidate = generate([original], 16, 0, bars=(1, 3), backend=StubBackend())[0][0]
+
+    spliced = splice_bars(original, candidate, (1, 3), 16)
+
+    def kept(track):
+        # everything but the generated notes, delta times aside
+        return [(beat, msg.copy(time=0)) for beat, msg in zip(track.event_beats, track.events)
+                if msg.type == "control_change" or msg.note in (30, 100)]
+    assert kept(spliced) == kept(original)
+    assert all(4 <= note["start"] < 12 for note in spliced.note_array if note["pitch"] not in (30, 100))
+
+def test_note_held_over_the_loop_end_keeps_its_wrapped_note_off():
+    # recorded across the wrap: note-on at the loop end, note-off after it
+    original = make_track(note(9, 10, 64) + [
+        (15, mido.Message("note_on", note=30, velocity=80)),
+        (0.5, mido.Message("note_off", note=30, velocity=0)),
+    ])
+    candidate = generate([original], 16, 0, bars=(1, 2), backend=StubBackend())[0][0]
+
+    spliced = splice_bars(original, candidate, (1, 2), 16)
+    wrapped = [(beat, msg.type) for beat, msg in zip(spliced.event_beats, spliced.events) if msg.note == 30]
+    assert wrapped == [(0.5, "note_off"), (15, "note_on")]
+
+def test_session_key_survives_installing_a_variation():
+    original = make_track(note(2, 6, 60) + note(12, 13, 62))
+    key = session_key([original, None], 16, 0, bars=(1, 2))
+    candidate = generate([original, None], 16, 0, bars=(1, 2), backend=StubBackend())[0][0]
+
+    installed = splice_bars(original, candidate, (1, 2), 16)
+    assert session_key([installed, None], 16, 0, bars=(1, 2)) == key
+    assert session_key([installed, None], 16, 0, bars=(2, 3)) != key
@@ -0,0 +1,46 @@
+import mido
+import numpy as np
+
+from midi import Track
+
+def reparsed(track):
+    return Track(mido.MidiTrack(msg.copy() for msg in track.midi_track), track.ticks_per_beat)
+
+def sorted_notes(track):
+    return np.sort(track.note_array, order=["start", "pitch", "duration"])
+
+def test_record_matches_read_after_wrapped_overdub():
+    ticks_per_beat = 480
+    midi_track = mido.MidiTrack([
+        mido.Message("note_on", note=60, velocity=90, time=4 * ticks_per_beat),
+        mido.Message("note_off", note=60, velocity=0, time=ticks_per_beat),
+    ])
+    track = Track(midi_track, ticks_per_beat)
+
+    # (beats, message) as they arrive while overdubbing a 16 beat loop:
+    # held over the loop end, then the same pitch again after the wrap
+    arrivals = [
+        (15, mido.Message("note_on", note=60, velocity=100)),
+        (0.5, mido.Message("note_off", note=60, velocity=0)),
+        (1, mido.Message("note_on", note=60, velocity=80)),
+        (2, mido.Message("note_off", note=60, velocity=0)),
+        (3, mido.Message("note_on", note=60, velocity=70)),
+        (3.5, mido.Message("note_on", note=64, velocity=70)),
+        (4.5, mido.Message("note_off", note=60, velocity=0)),
+        (6, mido.Message("note_off", note=64, velocity=0)),
+    ]
+    for beats, msg in arrivals:
+        track.record(msg, int(beats * ticks_per_beat))
+
+    expected = reparsed(track)
+    assert np.array_equal(sorted_notes(track), sorted_notes(expected))
+    assert sum(len(held) for held in track.notes_on.values()) == sum(len(held) for held in expected.notes_on.values())
+
+def test_record_in_order_matches_read():
+    track = Track(None)
+    for i in range(8):
+        track.record(mido.Message("note_on", note=60 + i % 3, velocity=90), i * 240)
+        track.record(mido.Message("note_off", note=60 + i % 3, velocity=0), i * 240 + 200)
+
+    assert track.note_count == 8
+    assert np.array_equal(sorted_notes(track), sorted_notes(reparsed(track)))
@@ -2,12 +2,15 @@ from PyQt6.QtWidgets import QGraphicsView, QGraphicsScene
 
 from PyQt6.QtGui import (
     QPainter, QColor, QPen, QBrush, 
-    QPaintEvent
+    QPaintEvent, QPixmap
 )
+from PyQt6.QtCore import Qt
 
-from midi import ( Track, Note, ControlChange )
+from midi import ( Track, Note, ControlChange, BEATS_PER_BAR )
 
+import math
 import colorsys
+import numpy as np
 
 def velocity_color(velocity):
     """
@@ -28,6 +31,49 @@ def velocity_color(velocity):
     return f"#{r:02x}{g:02x}{b:02x}"
 
         
+def pitch_class_color(pitch):
+    """
+    Colour a MIDI pitch by pitch class, going round the hue circle once per octave.
+    
+    :param pitch: MIDI note number (0-127)
+    :return: Hex color string in "#RRGGBB" format
+    """
+    rgb = colorsys.hsv_to_rgb((pitch % 12) / 12, 0.8, 1)
+    r, g, b = [int(c * 255) for c in rgb]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def track_color(track_index):
+    """
+    Colour a track by its index, spacing hues by the golden ratio so
+    neighbouring tracks stay distinct.
+    
+    :param track_index: track number
+    :return: Hex color string in "#RRGGBB" format
+    """
+    rgb = colorsys.hsv_to_rgb((track_index * 0.618033988749895) % 1, 0.7, 1)
+    r, g, b = [int(c * 255) for c in rgb]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+# scheme name -> (colour of an index 0-127, what a note is indexed by)
+COLOR_SCHEMES = {
+    "velocity": (velocity_color, "velocity"),
+    "pitch_class": (pitch_class_color, "pitch"),
+    "track": (track_color, "track"),
+}
+
+palettes = {}
+
+def palette(scheme):
+    """
+    Return the 128 precomputed brushes of a colour scheme, built on first use
+    and shared by everything that draws notes.
+    """
+    brushes = palettes.get(scheme)
+    if brushes is None:
+        color_function = COLOR_SCHEMES[scheme][0]
+        brushes = palettes[scheme] = [QBrush(QColor(color_function(i))) for i in range(128)]
+    return brushes
+
 class Timeline(QGraphicsView):
     def __init__(self, beats=16, track_count=8):
         super().__init__()
@@ -35,8 +81,14 @@ class Timeline(QGraphicsView):
         self.playhead_position = 0
         self.active_track_index = 0
         self.tracks = [None] * track_count
+        self.layers = [None] * track_count          # cached note pixmap per track
+        self.layer_keys = [None] * track_count      # what each cached layer was drawn from
+        self.color_scheme = "velocity"
         self.setScene(QGraphicsScene())
         self.recording = False
+        self.selection = None                       # (track index, first bar, end bar) to regenerate
+        self.selection_anchor = None
+        self.on_selection_change = None
         #self.setBackgroundBrush(Qt.GlobalColor.clear)
         
     def paintEvent(self, event):
@@ -70,33 +122,130 @@ class Timeline(QGraphicsView):
                 track_index += 1
                 continue
             
-            highest_note = track.highest_note
-            lowest_note = track.lowest_note - 1
-            
-            for note in track.notes:
-                
-                start = note.start
-                
-                if track.quantisation != 0:
-                   start = round(note.start * track.quantisation) / track.quantisation
-                
-                x = int(start * self.width() / self.beats)
-                y = int(track_index * track_height) + int((highest_note - note.pitch) / (highest_note - lowest_note) * track_height)
-                width = int(note.duration * self.width() / self.beats)
-                height = int(track_height / (highest_note - lowest_note))
-                fill = QBrush(QColor(velocity_color(note.velocity)))
-                qp.fillRect(x, y, width, height, fill)
+            # the notes come from a cached layer, redrawn only when stale
+            qp.drawPixmap(0, int(track_index * track_height), self.trackLayer(track_index, track_height))
                 
             track_index += 1
                 
+        # draw the selected bars
+        if self.selection is not None:
+            selected_track, first_bar, end_bar = self.selection
+            x = int(first_bar * BEATS_PER_BAR * self.width() / self.beats)
+            end_x = int(min(end_bar * BEATS_PER_BAR, self.beats) * self.width() / self.beats)
+            qp.setPen(QPen(QColor(255, 255, 255, 120), 1))
+            qp.setBrush(QBrush(QColor(255, 255, 255, 40)))
+            qp.drawRect(x, int(selected_track * track_height), end_x - x, int(track_height))
+            
         # draw control changes...
                 
         # draw playhead
         #x = int(self.playhead_position * self.width() / self.beats)
         #qp.setPen(QPen(Qt.GlobalColor.red, 2))
         #qp.drawLine(x, 15, x, self.height())
+        
+    def trackLayer(self, track_index, track_height):
+        """
+        Return the pixmap with the notes of one track, redrawing it only if
+        the track, its notes, its quantisation or the widget size changed.
+        """
+        track = self.tracks[track_index]
+        layer_width = self.width()
+        key = (
+            id(track), track.version, 
+            track.quantisation, track.strength, track.swing, 
+            track.lowest_note, track.highest_note,
+            layer_width, track_height, self.beats, self.color_scheme
+        )
+        
+        if self.layer_keys[track_index] == key:
+            return self.layers[track_index]
+        
+        ratio = self.devicePixelRatioF()
+        layer = QPixmap(max(1, int(layer_width * ratio)), max(1, int(track_height * ratio) + 1))
+        layer.setDevicePixelRatio(ratio)
+        layer.fill(Qt.GlobalColor.transparent)
+        
+        qp = QPainter(layer)
+        
+        highest_note = track.highest_note
+        lowest_note = track.lowest_note - 1
+        note_range = highest_note - lowest_note
+        
+        # note rectangles for the whole track at once
+        notes = track.note_array
+        scale = layer_width / self.beats
+        xs = (track.quantised_starts() * scale).astype(np.int32)
+        ys = ((highest_note - notes["pitch"].astype(np.int32)) / note_range * track_height).astype(np.int32)
+        widths = (notes["duration"] * scale).astype(np.int32)
+        height = int(track_height / note_range)
+        
+        # index every note into the shared palette, no per-note colour work
+        brushes = palette(self.color_scheme)
+        column = COLOR_SCHEMES[self.color_scheme][1]
+        if column == "track":
+            indices = [track_index % 128] * len(notes)
+        else:
+            indices = notes[column].tolist()
+        
+        for x, y, width, index in zip(xs.tolist(), ys.tolist(), widths.tolist(), indices):
+            qp.fillRect(x, y, width, height, brushes[index])
+            
+        qp.end()
+        
+        self.layers[track_index] = layer
+        self.layer_keys[track_index] = key
+        return layer
+        
+    def setColorScheme(self, scheme):
+        if scheme not in COLOR_SCHEMES:
+            raise ValueError(f"Unknown colour scheme: {scheme}")
+        self.color_scheme = scheme
+        self.viewport().update()
+        
+    def invalidateLayer(self, track_index):
+        self.layers[track_index] = None
+        self.layer_keys[track_index] = None
+        
+    def barAt(self, x):
+        bars = max(1, math.ceil(self.beats / BEATS_PER_BAR))
+        return min(max(0, int(x * self.beats / self.width() / BEATS_PER_BAR)), bars - 1)
+    
+    def trackAt(self, y):
+        return min(max(0, int(y * len(self.tracks) / self.height())), len(self.tracks) - 1)
+    
+    def mousePressEvent(self, event):
+        # drag across a track to select bars to regenerate, right click clears
+        if event.button() == Qt.MouseButton.RightButton:
+            self.setSelection(None)
+            return
+        if event.button() == Qt.MouseButton.LeftButton:
+            position = event.position()
+            track_index = self.trackAt(position.y())
+            bar = self.barAt(position.x())
+            self.selection_anchor = (track_index, bar)
+            self.setSelection((track_index, bar, bar + 1))
+            
+    def mouseMoveEvent(self, event):
+        if self.selection_anchor is None:
+            return
+        track_index, anchor = self.selection_anchor
+        bar = self.barAt(event.position().x())
+        self.setSelection((track_index, min(anchor, bar), max(anchor, bar) + 1))
+        
+    def mouseReleaseEvent(self, event):
+        self.selection_anchor = None
+        
+    def setSelection(self, selection):
+        if selection == self.selection:
+            return
+        self.selection = selection
+        self.viewport().update()
+        if self.on_selection_change:
+            self.on_selection_change(selection)
+        
     def setTrack(self, track, track_number):
         self.tracks[track_number] = track
+        self.invalidateLayer(track_number)
     
     def setActiveTrack(self, track_index):
-        self.active_track_index = track_index
\ No newline at end of file
+        self.active_track_index = track_index
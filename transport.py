@@ -0,0 +1,304 @@
+import os
+import math
+import time
+import heapq
+import threading
+from ctypes import c_void_p, c_int, c_uint, c_short
+
+import fluidsynth
+
+import latency
+
+# sequencer events pyfluidsynth does not wrap
+fluid_event_control_change = fluidsynth.cfunc('fluid_event_control_change', None,
+                                              ('evt', c_void_p, 1),
+                                              ('channel', c_int, 1),
+                                              ('control', c_short, 1),
+                                              ('val', c_int, 1))
+
+fluid_event_pitch_bend = fluidsynth.cfunc('fluid_event_pitch_bend', None,
+                                          ('evt', c_void_p, 1),
+                                          ('channel', c_int, 1),
+                                          ('pitch', c_int, 1))
+
+fluid_event_program_select = fluidsynth.cfunc('fluid_event_program_select', None,
+                                               ('evt', c_void_p, 1),
+                                               ('channel', c_int, 1),
+                                               ('sfont_id', c_uint, 1),
+                                               ('bank_num', c_short, 1),
+                                               ('preset_num', c_short, 1))
+
+fluid_sequencer_remove_events = fluidsynth.cfunc('fluid_sequencer_remove_events', None,
+                                                 ('seq', c_void_p, 1),
+                                                 ('source', c_short, 1),
+                                                 ('dest', c_short, 1),
+                                                 ('type', c_int, 1))
+
+class LoopSequencer(fluidsynth.Sequencer):
+    """
+    fluidsynth sequencer (1000 ticks per second) with the extra events the
+    looper plays back and a way to drop everything still queued.
+    """
+
+    def control_change(self, time, channel, control, value, source=-1, dest=-1, absolute=True):
+        evt = self._create_event(source, dest)
+        fluid_event_control_change(evt, channel, control, value)
+        self._schedule_event(evt, time, absolute)
+        fluidsynth.delete_fluid_event(evt)
+
+    def pitch_bend(self, time, channel, pitch, source=-1, dest=-1, absolute=True):
+        evt = self._create_event(source, dest)
+        # mido pitch is -8192..8191, fluidsynth expects 0..16383
+        fluid_event_pitch_bend(evt, channel, pitch + 8192)
+        self._schedule_event(evt, time, absolute)
+        fluidsynth.delete_fluid_event(evt)
+
+    def program_select(self, time, channel, sfid, bank, preset, source=-1, dest=-1, absolute=True):
+        evt = self._create_event(source, dest)
+        fluid_event_program_select(evt, channel, sfid, bank, preset)
+        self._schedule_event(evt, time, absolute)
+        fluidsynth.delete_fluid_event(evt)
+
+    def remove_events(self, source=-1, dest=-1, type=-1):
+        if fluid_sequencer_remove_events is not None:
+            fluid_sequencer_remove_events(self.sequencer, source, dest, type)
+
+class Transport:
+    """
+    Drives a Looper from its own thread instead of the GUI timer.
+
+    Every cycle the transport advances the looper's clock and schedules the
+    events falling in the next `lookahead` seconds as timestamped events, on
+    the fluidsynth sequencer when the looper uses a fluidsynth synth, or on an
+    internal queue fired by this thread otherwise. Positions are tracked in
+    unwrapped beats (loops * beats + elapsed_beats) so a lookahead window that
+    crosses the loop boundary schedules the end of this loop and the start of
+    the next one.
+    """
+
+    def __init__(self, looper, lookahead=0.05, interval=0.002, idle_interval=0.01):
+        self.looper = looper
+        self.lookahead = lookahead          # seconds scheduled ahead of the playhead
+        self.interval = interval            # seconds between scheduling cycles
+        self.idle_interval = idle_interval  # seconds between cycles while stopped
+
+        self.thread = None
+        self.running = False
+
+        self.scheduled_beats = None         # unwrapped beat up to which events are queued
+        self.last_position = None
+        self.pending = []                   # heap of (fire time, order, function, args)
+        self.pending_count = 0
+
+        self.sequencer = None
+        self.synth_dest = -1
+
+        if isinstance(looper.synth, fluidsynth.Synth):
+            self.sequencer = LoopSequencer(time_scale=1000, use_system_timer=True)
+            self.synth_dest = self.sequencer.register_fluidsynth(looper.synth)
+
+        looper.transport = self
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="transport", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.cancel()
+
+    def is_running(self):
+        return self.running
+
+    def drainsInput(self):
+        # the looper's input queue has one consumer, this thread while it exists
+        return self.thread is not None
+
+    def raisePriority(self):
+        # on Linux the nice value of a thread id only affects that thread
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10)
+        except (AttributeError, OSError):
+            print("Transport running at normal priority")
+
+    def run(self):
+        self.raisePriority()
+
+        input_queue = self.looper.input_queue
+        intended = None
+
+        while self.running:
+            current_time = time.time()
+            if intended is not None and latency.monitor.enabled:
+                latency.monitor.record('cycle', current_time - intended)
+            self.cycle(current_time)
+
+            # while playing, polling every interval picks up input without
+            # the MIDI thread touching a lock; stopped with nothing pending,
+            # sleep longer and let the input queue wake us
+            if not self.looper.is_playing() and not self.pending:
+                intended = time.time() + self.idle_interval
+                # woken early by input, not a late cycle
+                if input_queue.sleep(self.idle_interval):
+                    intended = None
+                continue
+
+            wait = self.interval
+            if self.pending:
+                wait = min(wait, max(0, self.pending[0][0] - time.time()))
+            intended = time.time() + wait
+            time.sleep(wait)
+
+    def cycle(self, current_time):
+        looper = self.looper
+        delta_beats = looper.advance(current_time)
+        looper.drainInput()
+
+        if not looper.is_playing():
+            if self.scheduled_beats is not None:
+                self.cancel()
+            self.fire(current_time)
+            return
+
+        position = looper.loops * looper.beats + looper.elapsed_beats
+
+        # the playhead jumped back (reset), drop whatever was queued
+        if self.last_position is not None and position < self.last_position:
+            self.cancel()
+
+        self.last_position = position
+
+        # (re)starting: include the beats played since the clock started
+        if self.scheduled_beats is None:
+            self.scheduled_beats = position - delta_beats
+
+        horizon = position + self.lookahead * looper.bpm / 60
+
+        if horizon > self.scheduled_beats:
+            self.schedule(self.scheduled_beats, horizon, position, current_time)
+            self.scheduled_beats = horizon
+
+        self.fire(time.time())
+
+    def schedule(self, start, end, position, current_time):
+        """
+        Queue every event in the unwrapped beat window [start, end), splitting
+        it at loop boundaries.
+        """
+        looper = self.looper
+        beats = looper.beats
+        seconds_per_beat = 60 / looper.bpm
+        sequencer_tick = self.sequencer.get_tick() if self.sequencer else 0
+        timed = latency.monitor.enabled
+
+        loop = int(start // beats)
+
+        while loop * beats < end:
+            offset = loop * beats
+
+            # tracks queued for the next loop go in before its first event
+            if start <= offset:
+                looper.spliceQueued()
+
+            local_start = max(start, offset) - offset
+            local_end = min(end, offset + beats) - offset
+
+            beat = math.ceil(local_start)
+            while beat < local_end:
+                fire_time = current_time + (offset + beat - position) * seconds_per_beat
+
+                # soundfont switches land on the beat, before its notes
+                for switch in looper.takeSwitches(beat == 0):
+                    self.scheduleSwitch(switch, fire_time, sequencer_tick + max(0, int((fire_time - current_time) * 1000)))
+
+                # the metronome places clicks on its own sample clock
+                if looper.metronome_active:
+                    looper.playMetronome(beat, fire_time)
+                beat += 1
+
+            for track_index in range(len(looper.tracks)):
+
+                if not looper.isAudible(track_index):
+                    continue
+
+                track = looper.tracks[track_index]
+                lo, hi = track.event_range(local_start, local_end)
+
+                for i in range(lo, hi):
+                    delay = (offset + track.event_beats[i] - position) * seconds_per_beat
+                    msg = track.events[i]
+
+                    if self.sequencer:
+                        if timed:
+                            latency.monitor.record('slack', delay)
+                        self.send(sequencer_tick + max(0, int(delay * 1000)), track_index, msg)
+                    else:
+                        self.push(current_time + delay, looper.playMessage, (track_index, msg))
+
+            loop += 1
+
+    def scheduleSwitch(self, switch, fire_time, tick):
+        synth = self.looper.synth
+        if self.sequencer:
+            self.sequencer.program_select(tick, switch.track_number, switch.sfid, switch.bank, switch.preset, dest=self.synth_dest)
+            self.push(fire_time, synth.switchApplied, (switch,))
+        else:
+            self.push(fire_time, synth.applySwitch, (switch,))
+
+    def send(self, tick, channel, msg):
+        sequencer = self.sequencer
+        dest = self.synth_dest
+
+        if msg.type == "note_on":
+            sequencer.note_on(tick, channel, msg.note, msg.velocity, dest=dest)
+
+        elif msg.type == "note_off":
+            sequencer.note_off(tick, channel, msg.note, dest=dest)
+
+        elif msg.type == "pitchwheel":
+            sequencer.pitch_bend(tick, channel, msg.pitch, dest=dest)
+
+        elif msg.type == "control_change":
+            sequencer.control_change(tick, channel, msg.control, msg.value, dest=dest)
+
+    def push(self, fire_time, function, args):
+        heapq.heappush(self.pending, (fire_time, self.pending_count, function, args))
+        self.pending_count += 1
+
+    def fire(self, current_time):
+        # with a sequencer the queue only holds switch notifications
+        timed = latency.monitor.enabled and not self.sequencer
+        while self.pending and self.pending[0][0] <= current_time:
+            fire_time, _, function, args = heapq.heappop(self.pending)
+            function(*args)
+            if timed:
+                latency.monitor.record('playback', time.time() - fire_time)
+
+    def cancel(self):
+        """
+        Drop every queued event and silence the tracks, used on pause, reset
+        and stop so no note-on fires without its note-off.
+        """
+        if self.sequencer:
+            self.sequencer.remove_events()
+
+        # switches already taken for a boundary are applied now instead
+        synth = self.looper.synth
+        for _, _, function, args in self.pending:
+            if synth is not None and function in (getattr(synth, "switchApplied", None), getattr(synth, "applySwitch", None)):
+                synth.applySwitch(*args)
+        self.pending.clear()
+        self.looper.metronome.cancel()
+        self.scheduled_beats = None
+        self.last_position = None
+
+        synth = self.looper.synth
+        if synth is not None:
+            for i in range(len(self.looper.tracks)):
+                synth.all_notes_off(i)